@@ -11,11 +11,23 @@ Script: What to execute.
     ID: int The real identifier.
     Type: ScriptSectionType How to handle content(Embedded or Reference)
     Content: str
+    Depends: [int] IDs of sections that must finish first(optional).
+      If no section lists dependencies, sections run one after another.
+      Otherwise sections run in parallel once their dependencies finish, getting the variables those set.
+    Timeout: float Most seconds the section may run before it is killed(optional).
   Requires: [str] List of executables needed to run the script.
 Output: Output of each Script section(optional)
   Section
     ID: int
-    Content: str
+    Stdout: str
+    Stderr: str
+    Content: str stdout and stderr together, only in older files.
+    Stats: How the section ran(optional), see SectionStats.
+      wall_time, cpu_time: float Seconds, cpu_time is user and system time of the section's processes.
+      max_rss: int Peak resident memory in KiB, sampled while the section runs so very short ones have none.
+      exit_code: int
+      stdout_bytes, stderr_bytes: int Bytes of output, before decoding.
+      What an engine or platform can't measure is null.
 Document: How to generate the document.
   Section
     Name: str Name of section, for readability.
@@ -25,16 +37,56 @@ Document: How to generate the document.
     Pattern: Patterns for setting content from output.
       pattern_str: str The regex pattern to match.
       match_content: str the content to use if matched.
+      A pattern_str starting with "nmap:" queries the nmap output instead, see nmap_parse.py.
 Variables: dict Key Value pairs to pass into script sections.
   If there is a key with no value("") then ask user for this.
+Targets: Output of each target from a batch run against many hosts(optional)
+  Target: str The value given to the target variable, e.g. the ip.
+    Output: same as Output above.
 """
 import typing
 # from typing_extensions import Self
+import contextlib
+import io
 import json
+import os
+import re
+import shutil
+import tempfile
 from enum import Enum
 
+import nmap_parse
+
+UMASK = os.umask(0)  # Read once here, setting it back and forth later would race other threads.
+os.umask(UMASK)
+
+
+@contextlib.contextmanager
+def atomic_file(path: str):
+    """
+    Binary file that takes the place of path once the block is done.
+    Written next to path and renamed over it, so path is either the old file or the whole new one, never half.
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else:  # mkstemp makes it 0600, a new file gets what open would have given it.
+            os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
 
 class SectionBase:
+    # Just the id, so SectionOutput can do without __dict__. Other sections keep content in their __dict__.
+    __slots__ = ("section_id",)
+
     def __init__(self, section_id: int, content: str):
         self.section_id = section_id
         self.content = content
@@ -64,17 +116,26 @@ class ScriptSectionType(Enum):
 
 
 class SectionScript(SectionBase):
-    def __init__(self, section_id: int, name: str, section_type: ScriptSectionType, content: str):
+    def __init__(self, section_id: int, name: str, section_type: ScriptSectionType, content: str,
+                 depends: list[int] = None, timeout: float = None):
         super().__init__(section_id, content)
         self.name = name
         self.section_type = section_type
+        self.depends = depends if depends is not None else []
+        self.timeout = timeout
 
     def to_dict(self) -> dict:
-        return super().to_dict() | {"name": self.name, "type": self.section_type.value}
+        out = super().to_dict() | {"name": self.name, "type": self.section_type.value}
+        if self.depends:
+            out["depends"] = self.depends
+        if self.timeout:
+            out["timeout"] = self.timeout
+        return out
 
     @classmethod
     def from_dict(cls, in_dict: dict):
-        return cls(in_dict["id"], in_dict["name"], ScriptSectionType(in_dict["type"]), in_dict["content"])
+        return cls(in_dict["id"], in_dict["name"], ScriptSectionType(in_dict["type"]), in_dict["content"],
+                   in_dict.get("depends", []), in_dict.get("timeout"))
 
 
 class DocumentSectionType(Enum):
@@ -102,6 +163,22 @@ class Pattern:
         self.match_content = match_content
         self.behavior = behavior
 
+    @property
+    def pattern_str(self) -> str:
+        return self._pattern_str
+
+    @pattern_str.setter
+    def pattern_str(self, value: str):
+        self._pattern_str = value
+        self._compiled: typing.Optional[re.Pattern] = None  # Compiled again the next time it's used.
+
+    @property
+    def compiled(self) -> re.Pattern:
+        """The compiled regex, raises re.error if pattern_str is invalid."""
+        if self._compiled is None:
+            self._compiled = re.compile(self._pattern_str)
+        return self._compiled
+
     def to_dict(self) -> dict:
         return {"pattern": self.pattern_str, "match_content": self.match_content, "behavior": self.behavior.value}
 
@@ -195,23 +272,249 @@ class Script:
         return cls.from_dict(json.loads(json_str))
 
 
+class SectionList(list):
+    """
+    List of sections that also keeps them by id, so finding a section doesn't mean walking the list.
+    The index follows every change made through the list, section ids are expected to be unique.
+    Where each id is in the list is kept too, found again only after a change that moves sections.
+    """
+    def __init__(self, sections: typing.Iterable = ()):
+        super().__init__(sections)
+        self.index: dict[int, SectionBase] = {section.section_id: section for section in self}
+        self.positions: typing.Optional[dict[int, int]] = None
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def reindex(self):
+        self.index = {section.section_id: section for section in self}
+        self.positions = None
+
+    def position(self, section_id: int) -> int:
+        if self.positions is None:
+            self.positions = {section.section_id: i for i, section in enumerate(self)}
+        return self.positions[section_id]
+
+    def replace(self, section: SectionBase):
+        """Put section where the section with its id is, nothing moves."""
+        super().__setitem__(self.position(section.section_id), section)
+        self.index[section.section_id] = section
+
+    def forget(self, section: SectionBase):
+        if self.index.get(section.section_id) is section:
+            del self.index[section.section_id]
+
+    def append(self, section: SectionBase):
+        super().append(section)
+        self.index[section.section_id] = section
+        if self.positions is not None:
+            self.positions[section.section_id] = len(self) - 1
+
+    def extend(self, sections: typing.Iterable):
+        for section in sections:
+            self.append(section)
+
+    def __iadd__(self, sections: typing.Iterable):
+        self.extend(sections)
+        return self
+
+    def insert(self, i: typing.SupportsIndex, section: SectionBase):
+        super().insert(i, section)
+        self.index[section.section_id] = section
+        self.positions = None
+
+    def pop(self, i: typing.SupportsIndex = -1):
+        section = super().pop(i)
+        self.forget(section)
+        self.positions = None
+        return section
+
+    def remove(self, section: SectionBase):
+        super().remove(section)
+        self.forget(section)
+        self.positions = None
+
+    def clear(self):
+        super().clear()
+        self.index.clear()
+        self.positions = None
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.positions = None
+
+    def reverse(self):
+        super().reverse()
+        self.positions = None
+
+    def __setitem__(self, i, value):
+        super().__setitem__(i, value)
+        self.reindex()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.reindex()
+
+
+class SectionContainer:
+    """Lookups by id for anything holding a SectionList of sections."""
+    def __init__(self, sections: list):
+        self.sections = sections
+
+    @property
+    def sections(self) -> SectionList:
+        return self._sections
+
+    @sections.setter
+    def sections(self, sections: list):
+        self._sections = sections if isinstance(sections, SectionList) else SectionList(sections)
+
+    def get_section(self, section_id: int):
+        """The section with section_id, or None."""
+        return self._sections.index.get(section_id)
+
+    def has_section(self, section_id: int) -> bool:
+        return section_id in self._sections.index
+
+    def add_section(self, section: SectionBase):
+        self._sections.append(section)
+
+    def remove_section(self, section_id: int):
+        """Remove the section with section_id, if there is one. Returns it."""
+        section = self._sections.index.get(section_id)
+        if section is not None:
+            self._sections.remove(section)
+        return section
+
+    def put_section(self, section: SectionBase):
+        """Replace the section with the same id in place, or add it at the end."""
+        if section.section_id in self._sections.index:
+            self._sections.replace(section)
+        else:
+            self._sections.append(section)
+
+
+class Blob:
+    """Text kept somewhere else until it is needed, like an output in an .atk container."""
+    keep = True  # Whether the text is kept in memory once read, or read again each time.
+
+    def read(self) -> str:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        """About how big the text is, without reading it where the blob can tell."""
+        return len(self.read())
+
+    def open(self) -> typing.TextIO:
+        """Reader over the text, blobs that can read in pieces don't read it all at once."""
+        return io.StringIO(self.read(), newline="")
+
+
+class SectionStats:
+    """Time, memory and output of one section's run."""
+    def __init__(self, wall_time: float, cpu_time: float = None, max_rss: int = None, exit_code: int = None,
+                 stdout_bytes: int = 0, stderr_bytes: int = 0):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+        self.exit_code = exit_code
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+
+    def to_dict(self) -> dict:
+        return {"wall_time": self.wall_time, "cpu_time": self.cpu_time, "max_rss": self.max_rss,
+                "exit_code": self.exit_code, "stdout_bytes": self.stdout_bytes, "stderr_bytes": self.stderr_bytes}
+
+    @classmethod
+    def from_dict(cls, in_dict: dict):
+        return cls(in_dict["wall_time"], in_dict.get("cpu_time"), in_dict.get("max_rss"), in_dict.get("exit_code"),
+                   in_dict.get("stdout_bytes", 0), in_dict.get("stderr_bytes", 0))
+
+
 class SectionOutput(SectionBase):
-    def __init__(self, section_id: int, stdout: str, stderr: str):
-        super().__init__(section_id, f"stdout:\n{stdout}\nstderr:\n{stderr}")
-        self.stdout = stdout
-        self.stderr = stderr
+    # Outputs can be huge and many, each byte is kept once, content is built from stdout and stderr when asked for.
+    __slots__ = ("_stdout", "_stderr", "_hosts", "matches", "stats")
+    max_matches = 16  # Pattern lists whose matches are kept, the pattern editor makes a new one per change.
+
+    def __init__(self, section_id: int, stdout: typing.Union[str, Blob], stderr: typing.Union[str, Blob],
+                 stats: SectionStats = None):
+        self.section_id = section_id  # No SectionBase.__init__, content is a property here.
+        self._stdout = stdout
+        self._stderr = stderr
+        self._hosts: typing.Optional[list[nmap_parse.Host]] = None
+        # Indices of the patterns found in stdout, by the pattern_strs searched for. See patterns.matching_patterns.
+        self.matches: dict[tuple[str, ...], list[int]] = {}
+        self.stats = stats  # None for output from before stats were kept.
+
+    @property
+    def stdout(self) -> str:
+        if isinstance(self._stdout, Blob):
+            if not self._stdout.keep:
+                return self._stdout.read()
+            self._stdout = self._stdout.read()
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, value: typing.Union[str, Blob]):
+        self._stdout = value
+        self._hosts = None
+        self.matches = {}
+
+    @property
+    def stderr(self) -> str:
+        if isinstance(self._stderr, Blob):
+            if not self._stderr.keep:
+                return self._stderr.read()
+            self._stderr = self._stderr.read()
+        return self._stderr
+
+    @stderr.setter
+    def stderr(self, value: typing.Union[str, Blob]):
+        self._stderr = value
+
+    @property
+    def content(self) -> str:
+        return f"stdout:\n{self.stdout}\nstderr:\n{self.stderr}"
+
+    @staticmethod
+    def open_text(value: typing.Union[str, Blob]) -> typing.TextIO:
+        return value.open() if isinstance(value, Blob) else io.StringIO(value, newline="")
+
+    def streams(self) -> dict[str, typing.Union[str, Blob]]:
+        """stdout and stderr as kept, blobs aren't read."""
+        return {"stdout": self._stdout, "stderr": self._stderr}
+
+    def open_stdout(self) -> typing.TextIO:
+        """Reader over stdout, big output is read from disk as it goes rather than all at once."""
+        return self.open_text(self._stdout)
+
+    def open_stderr(self) -> typing.TextIO:
+        return self.open_text(self._stderr)
+
+    @property
+    def hosts(self) -> list[nmap_parse.Host]:
+        """Hosts found in stdout if it is nmap output, read the first time they are asked for."""
+        if self._hosts is None:
+            with self.open_stdout() as f:
+                self._hosts = nmap_parse.parse_file(f)
+        return self._hosts
 
     def to_dict(self) -> dict:
-        return super().to_dict() | {"stdout": self.stdout, "stderr": self.stderr}
+        # content is left out, it is only stdout and stderr again. Files that have it still load.
+        out = {"id": self.section_id, "stdout": self.stdout, "stderr": self.stderr}
+        if self.stats is not None:
+            out["stats"] = self.stats.to_dict()
+        return out
 
     @classmethod
     def from_dict(cls, in_dict: dict):
-        return cls(in_dict["id"], in_dict["stdout"], in_dict["stderr"])
+        stats = SectionStats.from_dict(in_dict["stats"]) if "stats" in in_dict else None
+        return cls(in_dict["id"], in_dict["stdout"], in_dict["stderr"], stats)
 
 
-class Output:
+class Output(SectionContainer):
     def __init__(self, sections: list[SectionOutput]):
-        self.sections = sections
+        super().__init__(sections)
 
     def to_dict(self):
         dict_sections = []
@@ -234,9 +537,9 @@ class Output:
         return cls.from_dict(json.loads(json_str))
 
 
-class Document:
+class Document(SectionContainer):
     def __init__(self, sections: list[SectionDocument]):
-        self.sections = sections
+        super().__init__(sections)
 
     def to_dict(self) -> dict:
         dict_sections = []
@@ -260,26 +563,47 @@ class Document:
 
 
 class Attack:
-    def __init__(self, meta: Meta, script: Script, document: Document, variables: dict, output: Output = None):
+    def __init__(self, meta: Meta, script: Script, document: Document, variables: dict, output: Output = None,
+                 targets: dict[str, Output] = None):
         self.meta = meta
         self.script = script
         self.output = output
         self.document = document
         self.variables = variables
+        self.targets = targets if targets is not None else {}
+        self.packed = False  # Saved as a container rather than JSON.
+
+    def for_target(self, target: str):
+        """The attack as if it was only run against target, for generating that target's report."""
+        return Attack(self.meta, self.script, self.document, self.variables, self.targets[target])
 
     def to_dict(self):
         final = {} | self.meta.to_dict() | self.script.to_dict() | self.document.to_dict() | {
             "variables": self.variables}
         if self.output is not None:
             final = final | self.output.to_dict()
+        if self.targets:
+            final = final | {"targets": {target: output.to_dict()["output"] for target, output in self.targets.items()}}
         return final
 
     def to_json(self):
         return json.dumps(self.to_dict())
 
-    def save(self, path: str) -> None:
-        with open(path, "w") as f:
-            f.write(self.to_json())
+    def save(self, path: str, packed: bool = None) -> None:
+        """
+        Save as JSON, or as a container when packed, see container.py.
+        packed defaults to the format the attack was loaded from, or a container once the output gets big.
+        """
+        import container  # container imports this module.
+
+        if packed is None:
+            packed = self.packed or container.output_size(self) > container.PACK_SIZE
+        if packed:
+            container.save(self, path)
+        else:
+            with atomic_file(path) as f:
+                f.write(self.to_json().encode("UTF-8"))
+        self.packed = packed
 
     @classmethod
     def from_dict(cls, in_dict: dict):
@@ -288,12 +612,16 @@ class Attack:
             output = {"output": in_dict["output"]}
         except KeyError:
             pass
+        targets = {}
+        for target, target_output in in_dict.get("targets", {}).items():
+            targets[target] = Output.from_dict({"output": target_output})
         if output is None:
             return cls(
                 Meta.from_dict({"meta": in_dict["meta"]}),
                 Script.from_dict({"script": in_dict["script"]}),
                 Document.from_dict({"document": in_dict["document"]}),
-                in_dict["variables"]
+                in_dict["variables"],
+                targets=targets
             )
         else:
             return cls(
@@ -301,7 +629,8 @@ class Attack:
                 Script.from_dict({"script": in_dict["script"]}),
                 Document.from_dict({"document": in_dict["document"]}),
                 in_dict["variables"],
-                Output.from_dict(output)
+                Output.from_dict(output),
+                targets
             )
 
     @classmethod
@@ -310,8 +639,13 @@ class Attack:
 
     @classmethod
     def load(cls, path: str):
-        with open(path, "r") as f:
-            return cls.from_json(f.read())
+        """Load a JSON attack or a container, whichever path is. Output is read when it is first used."""
+        import container  # These import this module.
+        import lazyload
+
+        if container.is_container(path):
+            return container.load(path)
+        return lazyload.load(path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+"""
+Generate the reports of many attacks at once, one worker process per core.
+Every worker compiles against the same precompiled preamble (see latex.py), built once before the workers start.
+
+python batch.py engagement/*.atk --out reports
+python batch.py engagement --per-target --jobs 4
+"""
+import argparse
+import glob
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import attack
+import latex
+import report
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="apt-batch", description="Generate the reports of many attacks.")
+    parser.add_argument("attacks", nargs="+", help=".atk files, or directories to take every .atk from")
+    parser.add_argument("--out", metavar="DIR",
+                        help="directory to write the reports to (default: next to each attack)")
+    parser.add_argument("--per-target", action="store_true",
+                        help="put every target of an attack in one report instead of one report each")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="most reports being built at once (default: number of cores)")
+    return parser.parse_args(argv)
+
+
+def find_attacks(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(glob.glob(os.path.join(path, "*.atk")))
+        else:
+            found.append(path)
+    return [os.path.abspath(path) for path in found]
+
+
+def build(atk_path: str, out_dir: str, per_target: bool, format_dir: str) -> list[str]:
+    """Generate the reports of one attack in a worker process. Returns the pdfs written."""
+    atk = attack.Attack.load(atk_path)
+    atk_dir = os.path.dirname(atk_path)
+    path = os.path.join(out_dir or atk_dir, os.path.splitext(os.path.basename(atk_path))[0])
+    return report.create_reports(atk, path, per_target, report.ReportCache(), formats=latex.FormatCache(format_dir),
+                                 base_dir=atk_dir)
+
+
+def error_message(error: BaseException) -> str:
+    if isinstance(error, (report.LatexException, report.PatternErrorException, report.EndDocumentException)):
+        return error.message
+    if isinstance(error, (KeyError, ValueError)):
+        return f"Attack was invalid ({error})"
+    return "".join(traceback.format_exception_only(type(error), error)).strip()
+
+
+def run(atk_paths: list[str], out_dir: str = None, per_target: bool = False, jobs: int = None,
+        on_done=None) -> dict[str, BaseException]:
+    """
+    Generate the reports of every attack in atk_paths, up to jobs at once.
+    on_done is called with (atk_path, pdfs, None) as each attack finishes or (atk_path, None, exception)
+    when it fails. Returns the exception of each attack that failed.
+    """
+    failed = {}
+    with latex.FormatCache() as formats:
+        # Built here once, or every worker would build the same format at the same time.
+        formats.format_for(latex.split_preamble(report.Report.create_document())[0])
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(build, atk_path, out_dir, per_target, formats.directory): atk_path
+                       for atk_path in atk_paths}
+            for future in as_completed(futures):
+                atk_path = futures[future]
+                try:
+                    written = future.result()
+                except Exception as e:
+                    failed[atk_path] = e
+                    if on_done is not None:
+                        on_done(atk_path, None, e)
+                    continue
+                if on_done is not None:
+                    on_done(atk_path, written, None)
+    return failed
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    atk_paths = find_attacks(args.attacks)
+    if not atk_paths:
+        print("No attacks found.", file=sys.stderr)
+        return 2
+    out_dir = os.path.abspath(args.out) if args.out else None
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    done = 0
+
+    def on_done(atk_path: str, written, error):
+        nonlocal done
+        done += 1
+        if error is None:
+            print(f"[{done}/{len(atk_paths)}] {atk_path}: wrote {', '.join(written)}", file=sys.stderr)
+        else:
+            print(f"[{done}/{len(atk_paths)}] {atk_path} failed: {error_message(error)}", file=sys.stderr)
+
+    failed = run(atk_paths, out_dir, args.per_target, args.jobs, on_done)
+    print(f"{len(atk_paths) - len(failed)} of {len(atk_paths)} attack(s) done, {len(failed)} failed.", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
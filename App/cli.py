@@ -0,0 +1,215 @@
+"""
+Run an attack and generate its report from the command line, without the ui.
+Nothing from PyQt is imported, pylatex is only imported when a report is made.
+
+python cli.py my_attack.atk --set ip=10.0.0.5 --report --save
+python cli.py my_attack.atk --targets hosts.txt --jobs 8 --report --per-target
+python cli.py my_attack.atk --no-run --stats stats.json
+"""
+import argparse
+import os
+import re
+import signal
+import sys
+
+import attack
+import engines
+import journal
+import profiler
+import runner
+import runstats
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="apt", description="Run an attack and generate its report.")
+    parser.add_argument("attack", help="path to the .atk file")
+    parser.add_argument("--set", metavar="NAME=VALUE", action="append", default=[],
+                        help="set an attack variable, can be given more than once")
+    parser.add_argument("--no-run", action="store_true", help="don't run the script, only generate the report")
+    parser.add_argument("--targets", metavar="FILE",
+                        help="file with one target per line, runs the attack against each of them")
+    parser.add_argument("--target-variable", metavar="NAME", default="ip",
+                        help="variable set to each target (default: ip)")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="most targets or independent sections running at once (default: 4)")
+    parser.add_argument("--report", metavar="FILE", nargs="?", const="",
+                        help="generate the report, named after the attack if FILE isn't given")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write how long each step of making the report took to FILE, as JSON, "
+                             "or as trace events if FILE ends in .trace.json")
+    parser.add_argument("--per-target", action="store_true",
+                        help="with --targets, put every target in one report instead of one report each")
+    parser.add_argument("--engine", choices=engines.ENGINES, default="",
+                        help="how sections are run: batch files, bash, or one long-lived shell "
+                             "(default: batch on Windows, posix elsewhere)")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="kill sections running longer than this, unless they set their own timeout")
+    parser.add_argument("--stats", metavar="FILE", nargs="?", const="",
+                        help="print how long each section took and the memory it used, "
+                             "also writing them to FILE as JSON if given")
+    parser.add_argument("--save", action="store_true", help="save the output back into the .atk file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print section output")
+    return parser.parse_args(argv)
+
+
+def read_targets(path: str) -> list[str]:
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def run_attack(atk: attack.Attack, engine: engines.Engine, jobs: int, quiet: bool,
+               log: journal.Journal = None, control: runner.RunControl = None):
+    control = control if control is not None else runner.RunControl()
+    outputs: list[attack.SectionOutput] = []
+    parallel = engine.parallel and any(section.depends for section in atk.script.sections)
+
+    def on_chunk(stream_name: str, text: str):
+        (sys.stdout if stream_name == "stdout" else sys.stderr).write(text)
+
+    def run_section(section: attack.SectionScript, variables: dict) -> dict:
+        if section.section_type is attack.ScriptSectionType.EMPTY:
+            return variables
+        print(f"Running section: {section.name}", file=sys.stderr)
+        output, exported = engine.run(section, variables, on_chunk=None if quiet or parallel else on_chunk,
+                                      control=control)
+        if control.cancelled:  # Killed, its output is only what it got to before.
+            return exported
+        if parallel and not quiet:
+            print(f"{'=' * 10}\nSection: {section.name}\n{'=' * 10}\n{output.content}")
+        outputs.append(output)
+        if log is not None:
+            log.record_output(output)
+        return exported
+
+    with engine:
+        runner.run_sections(atk.script.sections, run_section, atk.variables, jobs if engine.parallel else 1,
+                            control.wait_resumed)
+    if atk.output is None:
+        atk.output = attack.Output([])
+    for new in outputs:
+        atk.output.put_section(new)
+
+
+def run_targets(atk: attack.Attack, engine: engines.Engine, targets: list[str], variable: str,
+                jobs: int, log: journal.Journal = None, timeout: float = None,
+                control: runner.RunControl = None) -> bool:
+    failed = False
+
+    def on_done(target: str, error):
+        nonlocal failed
+        if error is None:
+            print(f"Finished target: {target}", file=sys.stderr)
+        else:
+            failed = True
+            print(f"Target {target} failed: {error}", file=sys.stderr)
+
+    def on_output(target: str, output: attack.Output):
+        if log is not None:
+            for section in output.sections:
+                log.record_output(section, target)
+
+    results = runner.run_targets(atk.script.sections, atk.variables, targets, variable, engine, jobs,
+                                 on_done, on_output, timeout, control)
+    atk.targets.update(results)
+    return not failed
+
+
+def generate_reports(atk: attack.Attack, atk_dir: str, path: str, per_target: bool,
+                     profile: profiler.Profiler = None):
+    import latex
+    import report  # pylatex is slow to import, only pay for it when making a report.
+
+    path = path if path else os.path.join(atk_dir, atk.meta.name)
+    cache = report.ReportCache()  # Sections that render the same for many targets are only rendered once.
+    with latex.FormatCache() as formats:  # Targets' reports share a preamble, it is compiled once.
+        for written in report.create_reports(atk, path, per_target, cache, profile, formats, atk_dir):
+            print(f"Wrote {written}", file=sys.stderr)
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    atk_path = os.path.abspath(args.attack)
+    report_path = os.path.abspath(args.report) if args.report else ""
+    stats_path = os.path.abspath(args.stats) if args.stats else ""
+    profile_path = os.path.abspath(args.profile) if args.profile else ""
+    atk_dir = os.path.dirname(atk_path)
+    try:
+        atk = attack.Attack.load(atk_path)
+    except (KeyError, ValueError):
+        print(f"Attack was invalid: {args.attack}", file=sys.stderr)
+        return 2
+    except FileNotFoundError:
+        print(f"No such attack: {args.attack}", file=sys.stderr)
+        return 2
+    log = journal.Journal(atk_path)
+    recovered = log.replay(atk)
+    if recovered:
+        print(f"Recovered {recovered} unsaved change(s) from {log.path}", file=sys.stderr)
+    for assignment in args.set:
+        name, sep, value = assignment.partition("=")
+        if not sep:
+            print(f"--set needs NAME=VALUE, got: {assignment}", file=sys.stderr)
+            return 2
+        atk.variables[name] = value
+    targets = read_targets(args.targets) if args.targets else []
+    missing = [name for name, value in atk.variables.items() if value == "" and not
+               (targets and name == args.target_variable)]
+    if missing and not args.no_run:
+        print(f"Variables need a value, use --set: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    ok = True
+    if not args.no_run:
+        with open(f"{APP_DIR}/prefix.bat", "r") as p:
+            prefix = p.read()
+        with open(f"{APP_DIR}/postfix.bat", "r") as p:
+            postfix = p.read()
+        engine = engines.create_engine(args.engine, APP_DIR, atk.meta.name, prefix, postfix, atk_dir)
+        control = runner.RunControl(args.timeout)
+        # Sections run in their own process groups and don't see Ctrl-C, it kills them from here instead.
+        handler = signal.signal(signal.SIGINT, lambda signum, frame: control.cancel())
+        try:
+            # With --save, finished sections are journaled so a crash doesn't lose them.
+            if targets:
+                ok = run_targets(atk, engine, targets, args.target_variable, args.jobs,
+                                 log if args.save else None, args.timeout, control)
+            else:
+                run_attack(atk, engine, args.jobs, args.quiet, log if args.save else None, control)
+        except (ValueError, FileNotFoundError) as e:
+            print(e, file=sys.stderr)
+            return 1
+        finally:
+            signal.signal(signal.SIGINT, handler)
+        if args.save:
+            log.compact(atk, atk_path)
+        if control.cancelled:
+            print("Run cancelled", file=sys.stderr)
+            return 130
+    if args.stats is not None:
+        print(runstats.format_summary(atk), file=sys.stderr)
+        if stats_path:
+            runstats.export(atk, stats_path)
+            print(f"Wrote {stats_path}", file=sys.stderr)
+    if args.report is not None:
+        import report
+        profile = profiler.Profiler() if profile_path else None
+        try:
+            generate_reports(atk, atk_dir, report_path, args.per_target, profile)
+        except (report.LatexException, report.PatternErrorException, report.EndDocumentException) as e:
+            print(e.message, file=sys.stderr)
+            return 1
+        except (ValueError, re.error) as e:  # A bad nmap query or pattern.
+            print(f"Attack was invalid ({e})", file=sys.stderr)
+            return 1
+        finally:
+            if profile is not None:
+                profile.export(profile_path)
+        if profile is not None:
+            print(f"Report took {profile.summary()}, wrote {profile_path}", file=sys.stderr)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
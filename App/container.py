@@ -0,0 +1,97 @@
+"""
+The packed .atk format, for attacks with a lot of captured output.
+A zip archive holding:
+  attack.json: Everything but the output, same as a JSON .atk without "output" and "targets".
+    Output sections only keep their id, "packed": {"output": [ids], "targets": {target: [ids]}},
+    their stats are under "packed": {"stats": {prefix: {id: stats}}}, prefix as in the member names below.
+  output/<id>/stdout, output/<id>/stderr: Each compressed on its own.
+  targets/<n>/<id>/stdout, targets/<n>/<id>/stderr: Output of the n-th target in "packed".
+Output is read from the archive the first time it is used, not when the attack is loaded.
+attack.Attack.load tells the formats apart by itself, Attack.save picks one, see there.
+"""
+import json
+import zipfile
+
+import attack
+
+PACK_SIZE = 16 * 1024 * 1024  # Characters of output past which an attack is saved packed.
+FORMAT_VERSION = 1
+
+
+class ZipBlob(attack.Blob):
+    """One member of a packed attack, read when the output is first used."""
+    def __init__(self, path: str, member: str):
+        self.path = path
+        self.member = member
+
+    def read(self) -> str:
+        with zipfile.ZipFile(self.path) as archive:
+            return archive.read(self.member).decode("UTF-8")
+
+    def size(self) -> int:
+        with zipfile.ZipFile(self.path) as archive:
+            return archive.getinfo(self.member).file_size
+
+
+def is_container(path: str) -> bool:
+    return zipfile.is_zipfile(path)
+
+
+def output_size(atk: attack.Attack) -> int:
+    """Characters of output, output still on disk counts by the size of what holds it."""
+    outputs = [atk.output] if atk.output is not None else []
+    outputs += list(atk.targets.values())
+    size = 0
+    for output in outputs:
+        for section in output.sections:
+            for text in (section._stdout, section._stderr):
+                size += text.size() if isinstance(text, attack.Blob) else len(text)
+    return size
+
+
+def write_output(archive: zipfile.ZipFile, prefix: str, output: attack.Output, stats: dict) -> list[int]:
+    ids = []
+    for section in output.sections:
+        archive.writestr(f"{prefix}/{section.section_id}/stdout", section.stdout.encode("UTF-8"))
+        archive.writestr(f"{prefix}/{section.section_id}/stderr", section.stderr.encode("UTF-8"))
+        ids.append(section.section_id)
+        if section.stats is not None:
+            stats.setdefault(prefix, {})[str(section.section_id)] = section.stats.to_dict()
+    return ids
+
+
+def read_output(path: str, prefix: str, ids: list[int], stats: dict) -> attack.Output:
+    stats = stats.get(prefix, {})
+    return attack.Output([attack.SectionOutput(section_id,
+                                               ZipBlob(path, f"{prefix}/{section_id}/stdout"),
+                                               ZipBlob(path, f"{prefix}/{section_id}/stderr"),
+                                               attack.SectionStats.from_dict(stats[str(section_id)])
+                                               if str(section_id) in stats else None)
+                          for section_id in ids])
+
+
+def save(atk: attack.Attack, path: str):
+    head = atk.meta.to_dict() | atk.script.to_dict() | atk.document.to_dict() | {"variables": atk.variables}
+    packed = {"version": FORMAT_VERSION, "targets": {}, "stats": {}}
+    # Lazy output may still be read from the file being replaced, atomic_file only replaces it at the end.
+    with attack.atomic_file(path) as f, zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+        if atk.output is not None:
+            packed["output"] = write_output(archive, "output", atk.output, packed["stats"])
+        for i, (target, output) in enumerate(atk.targets.items()):
+            packed["targets"][target] = write_output(archive, f"targets/{i}", output, packed["stats"])
+        archive.writestr("attack.json", json.dumps(head | {"packed": packed}))
+
+
+def load(path: str) -> attack.Attack:
+    with zipfile.ZipFile(path) as archive:
+        head = json.loads(archive.read("attack.json"))
+    packed = head.pop("packed")
+    if packed.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+        raise ValueError(f"Attack was packed by a newer version: {path}")
+    atk = attack.Attack.from_dict(head)
+    if "output" in packed:
+        atk.output = read_output(path, "output", packed["output"], packed.get("stats", {}))
+    for i, (target, ids) in enumerate(packed["targets"].items()):
+        atk.targets[target] = read_output(path, f"targets/{i}", ids, packed.get("stats", {}))
+    atk.packed = True
+    return atk
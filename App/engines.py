@@ -0,0 +1,221 @@
+"""
+Execution engines, how a script section is run and how variables get in and out of it.
+BatchEngine: A batch file per section wrapped in prefix.bat/postfix.bat, for Windows.
+PosixEngine: A bash process per section, variables go in through its environment and come back from env.
+SessionEngine: One long-lived shell for every section, see session.py.
+Every engine returns the section's output and the variables it exported, for runner's scheduler.
+"""
+import os
+import re
+import threading
+from typing import Callable, Optional
+
+import attack
+import runner
+import session
+
+
+class Engine:
+    parallel = True  # Whether sections may run side by side with this engine.
+
+    def __init__(self, cwd: str = None):
+        self.cwd = cwd  # Directory sections run in, relative paths in sections are relative to it.
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def path(self, name: str) -> str:
+        return name if self.cwd is None else os.path.join(self.cwd, name)
+
+    @staticmethod
+    def timeout(section: attack.SectionScript, control: Optional[runner.RunControl]) -> Optional[float]:
+        return control.section_timeout(section) if control is not None else section.timeout
+
+    def run(self, section: attack.SectionScript, variables: dict,
+            on_chunk: Optional[Callable[[str, str], None]] = None, job: str = "",
+            control: runner.RunControl = None) -> tuple[attack.SectionOutput, dict]:
+        """
+        Run one section with variables set.
+        job keeps the files of runs sharing a directory apart, like runs against different targets.
+        control is cancelled to kill the section, see runner.RunControl.
+        Returns the section's output and the variables to pass on to the sections depending on it.
+        """
+        raise NotImplementedError
+
+
+def clean_stderr(stderr: str) -> str:
+    err_lines = stderr.split("\r\n")
+    for i in reversed(range(len(err_lines))):
+        if re.match("^Could Not Find.*nv$", err_lines[i]):
+            err_lines.pop(i)
+        elif re.match("^The system cannot find the file .*nv\\.$", err_lines[i]):
+            err_lines.pop(i)
+    return "\r\n".join(err_lines)
+
+
+def write_variables(path: str, variables: dict):
+    """Write variables in the nv format prefix.bat imports."""
+    with open(path, "w") as f:
+        for name, value in variables.items():
+            f.write(f"{name}={value}\n")
+
+
+def read_variables(path: str) -> dict:
+    """Read variables from the nv format postfix.bat exports."""
+    variables = {}
+    with open(path, "r") as f:
+        for line in f:
+            name, sep, value = line.rstrip().partition("=")
+            if sep:
+                variables[name] = value
+    return variables
+
+
+class BatchEngine(Engine):
+    """
+    Runs each section as a batch file.
+    Variables are handed to prefix.bat through the section's own nv file, the variables the section
+    exported are read back from it by postfix.bat's output.
+    """
+    def __init__(self, app_dir: str, atk_name: str, prefix: str, postfix: str, cwd: str = None):
+        super().__init__(cwd)
+        self.app_dir = app_dir
+        self.atk_name = atk_name
+        self.prefix = prefix
+        self.postfix = postfix
+
+    def run(self, section: attack.SectionScript, variables: dict,
+            on_chunk: Optional[Callable[[str, str], None]] = None, job: str = "",
+            control: runner.RunControl = None) -> tuple[attack.SectionOutput, dict]:
+        tag = f"{self.atk_name}_{job}{section.section_id}_"  # Keeps iv/cv/dv/nv apart for sections side by side.
+        scr_path = self.path(f"{self.atk_name}_{job}{section.section_id}.bat")
+        nv_path = self.path(f"{tag}nv")
+        if section.section_type is attack.ScriptSectionType.REFERENCE:
+            with open(self.path(section.content), "r") as o:
+                content = o.read()
+        else:
+            content = section.content
+        write_variables(nv_path, variables)
+        with open(scr_path, "w") as f:
+            f.write(self.prefix + content + self.postfix.replace("diff.exe", f"{self.app_dir}\\diff.exe"))
+        try:
+            _, stdout, stderr, stats = runner.stream_process([scr_path], on_chunk, control,
+                                                             self.timeout(section, control), cwd=self.cwd,
+                                                             env=os.environ | {"APT_TAG": tag})
+        finally:
+            os.remove(scr_path)
+        try:
+            output = attack.SectionOutput(section.section_id, stdout.detach(), clean_stderr(stderr.getvalue()),
+                                          stats)
+        finally:
+            stdout.close()
+            stderr.close()
+        try:
+            exported = read_variables(nv_path)
+            os.remove(nv_path)
+        except FileNotFoundError:  # Nothing was exported.
+            exported = dict(variables)
+        return output, exported
+
+
+class PosixEngine(Engine):
+    """
+    Runs each section with bash.
+    Variables are put straight into the section's environment, after the section env writes its
+    environment to an extra pipe, anything exported that the section didn't start with is passed on.
+    Like any POSIX shell, variables that aren't exported stay in the section.
+    """
+    # Set by the shell itself, not by sections.
+    shell_variables = {"_", "SHLVL", "PWD", "OLDPWD"}
+
+    def __init__(self, cwd: str = None, shell: str = "bash"):
+        super().__init__(cwd)
+        self.shell = shell
+
+    def run(self, section: attack.SectionScript, variables: dict,
+            on_chunk: Optional[Callable[[str, str], None]] = None, job: str = "",
+            control: runner.RunControl = None) -> tuple[attack.SectionOutput, dict]:
+        if section.section_type is attack.ScriptSectionType.REFERENCE:
+            body = f". \"{section.content}\""  # Sourced so what it exports is seen.
+        else:
+            body = section.content
+        read_fd, write_fd = os.pipe()
+        script = f"{{\n{body}\n}} < /dev/null\n__apt_status=$?\nenv -0 >&{write_fd}\nexit $__apt_status\n"
+        env = os.environ | {name: str(value) for name, value in variables.items()}
+        dumped = []
+
+        def drain():
+            with open(read_fd, "rb") as f:
+                dumped.append(f.read())
+
+        reader = threading.Thread(target=drain, daemon=True)
+        reader.start()
+        try:
+            _, stdout, stderr, stats = runner.stream_process([self.shell, "-c", script], on_chunk, control,
+                                                             self.timeout(section, control), cwd=self.cwd,
+                                                             env=env, pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+            reader.join()
+        try:
+            output = attack.SectionOutput(section.section_id, stdout.detach(), stderr.detach(), stats)
+        finally:
+            stdout.close()
+            stderr.close()
+        if not dumped or not dumped[0]:  # The section exited before its environment was written.
+            return output, dict(variables)
+        exported = {}
+        for entry in dumped[0].decode("UTF-8", errors="replace").split("\0"):
+            name, sep, value = entry.partition("=")
+            if sep and name not in self.shell_variables and os.environ.get(name) != value:
+                exported[name] = value
+        return output, exported
+
+
+class SessionEngine(Engine):
+    """Runs every section in one long-lived shell, so sections can only run one at a time."""
+    parallel = False
+
+    def __init__(self, cwd: str = None):
+        super().__init__(cwd)
+        self.shell: Optional[session.ShellSession] = None
+
+    def start(self):
+        self.shell = session.ShellSession(self.cwd)
+        self.shell.start()
+
+    def close(self):
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+
+    def run(self, section: attack.SectionScript, variables: dict,
+            on_chunk: Optional[Callable[[str, str], None]] = None, job: str = "",
+            control: runner.RunControl = None) -> tuple[attack.SectionOutput, dict]:
+        return self.shell.run(section, variables, on_chunk, control, self.timeout(section, control))
+
+
+ENGINES = ["batch", "posix", "session"]
+
+
+def create_engine(name: str, app_dir: str, atk_name: str, prefix: str, postfix: str, cwd: str = None) -> Engine:
+    """Engine by name from ENGINES, or "" for the usual engine of this platform."""
+    if name == "":
+        name = "batch" if os.name == "nt" else "posix"
+    if name == "batch":
+        return BatchEngine(app_dir, atk_name, prefix, postfix, cwd)
+    elif name == "posix":
+        return PosixEngine(cwd)
+    elif name == "session":
+        return SessionEngine(cwd)
+    raise ValueError(f"Unknown engine: {name}")
@@ -0,0 +1,195 @@
+"""
+Journal of the changes to an attack since it was last saved, kept next to it as <attack>.journal.
+Each line is one JSON record, appended and flushed as soon as it happens:
+  {"op": "head", "value": {...}}: meta, script, document and variables after an edit, as in a JSON .atk.
+  {"op": "output", "section": {...}}: Output of a section that just finished running.
+  {"op": "output", "target": str, "section": {...}}: Same, for one target of a run against many.
+Output big enough to have gone to a temp file (see store.py) isn't copied in, the section has
+"stdout_file"/"stderr_file" with the temp file's path instead, and the file is kept until the journal is emptied.
+It can only be recovered while that file is still there, a reboot that clears the temp dir loses it.
+Appending a line is cheap, so outputs are journaled while a run goes instead of saving the whole attack.
+Compacting saves the attack and empties the journal. If the program died instead, replaying the journal
+on the attack as it was last saved gets back what was journaled. A line cut short by a crash is skipped.
+Outputs can be journaled before they are in the attack, as pending. Saving the attack then keeps the journal
+from the first pending output on, until applied says it got there.
+"""
+import json
+import os
+import threading
+import weakref
+
+import attack
+import store
+
+
+class Journal:
+    def __init__(self, atk_path: str):
+        self.path = atk_path + ".journal"
+        self.lock = threading.Lock()
+        self.file = None
+        self.records = 0  # Records appended since the journal was last emptied.
+        # Temp files of the outputs journaled by path, with the offset of the record referring to each.
+        self.pinned: dict[str, tuple[weakref.ref, int]] = {}
+        self.pending: dict[int, int] = {}  # Offsets of the outputs not in the attack yet, by record number.
+        self.appended = 0  # Record numbers handed out.
+
+    def append(self, record: dict, blobs: tuple = (), pending: bool = False) -> int:
+        """Append record, pinning the temp files of blobs for it. Returns the record's number."""
+        line = (json.dumps(record) + "\n").encode("UTF-8")
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+                if not self.ends_with_newline():
+                    self.file.write(b"\n")  # Cut short by a crash, don't run on from it.
+            start = self.file.tell()
+            for blob in blobs:
+                self.pin(blob, start)
+            self.file.write(line)
+            self.file.flush()
+            self.records += 1
+            self.appended += 1
+            if pending:
+                self.pending[self.appended] = start
+            return self.appended
+
+    def ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def record_head(self, atk: attack.Attack):
+        head = atk.meta.to_dict() | atk.script.to_dict() | atk.document.to_dict() | {"variables": atk.variables}
+        self.append({"op": "head", "value": head})
+
+    def pin(self, blob: store.SpillBlob, offset: int):
+        """Keep blob's temp file while the record at offset is in the journal. Called with the lock held."""
+        if blob.path not in self.pinned:
+            blob.pin()
+        self.pinned[blob.path] = (weakref.ref(blob), offset)
+
+    def record_output(self, output: attack.SectionOutput, target: str = None, pending: bool = False) -> int:
+        """
+        Journal output. pending is for output that isn't in the attack yet, see applied.
+        Returns the record's number.
+        """
+        section = {"id": output.section_id}
+        blobs = []
+        for name, value in output.streams().items():
+            if isinstance(value, store.SpillBlob):
+                blobs.append(value)
+                section[name + "_file"] = value.path
+            else:
+                section[name] = value.read() if isinstance(value, attack.Blob) else value
+        if output.stats is not None:
+            section["stats"] = output.stats.to_dict()
+        record = {"op": "output", "section": section}
+        if target is not None:
+            record["target"] = target
+        return self.append(record, tuple(blobs), pending)
+
+    def applied(self, record: int):
+        """The pending output of record is in the attack now."""
+        with self.lock:
+            self.pending.pop(record, None)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def replay(self, atk: attack.Attack) -> int:
+        """Apply the journal to atk, as loaded from its last save. Returns how many records were applied."""
+        applied = 0
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return 0
+        offset = 0
+        with f:
+            for line in f:
+                start = offset
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:  # Cut short when the program died.
+                    continue
+                if record["op"] == "head":
+                    loaded = attack.Attack.from_dict(record["value"])
+                    atk.meta, atk.script, atk.document, atk.variables = \
+                        loaded.meta, loaded.script, loaded.document, loaded.variables
+                elif record["op"] == "output":
+                    section = attack.SectionOutput.from_dict(self.load_files(record["section"], start))
+                    if "target" in record:
+                        atk.targets.setdefault(record["target"], attack.Output([])).put_section(section)
+                    else:
+                        if atk.output is None:
+                            atk.output = attack.Output([])
+                        atk.output.put_section(section)
+                applied += 1
+        return applied
+
+    def load_files(self, section: dict, offset: int) -> dict:
+        """section, of the record at offset, with the temp files it refers to as blobs."""
+        for name in ("stdout", "stderr"):
+            path = section.pop(name + "_file", None)
+            if path is None:
+                continue
+            if os.path.exists(path):
+                section[name] = store.SpillBlob(path)
+                with self.lock:
+                    self.pin(section[name], offset)
+            else:
+                section[name] = f"Output was lost, its temp file {path} is gone.\n"
+        return section
+
+    def clear(self):
+        """Empty the journal, pending outputs too."""
+        with self.lock:
+            self.pending = {}
+            self.drop(None)
+
+    def saved(self):
+        """The attack was saved, drop everything but the pending outputs and what came after them."""
+        with self.lock:
+            self.drop(min(self.pending.values(), default=None))
+
+    def drop(self, keep: int = None):
+        """Remove the records before offset keep, all of them if None. Called with the lock held."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if keep is None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.records = 0
+        else:
+            with open(self.path, "rb") as f:
+                f.seek(keep)
+                rest = f.read()
+            with attack.atomic_file(self.path) as f:
+                f.write(rest)
+            self.records = rest.count(b"\n")
+            self.pending = {record: start - keep for record, start in self.pending.items()}
+        for path, (ref, offset) in list(self.pinned.items()):
+            if keep is not None and offset >= keep:
+                self.pinned[path] = (ref, offset - keep)
+                continue
+            del self.pinned[path]
+            blob = ref()
+            if blob is None:
+                store.remove(path)
+            else:
+                blob.unpin()  # Removed with the blob again.
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def compact(self, atk: attack.Attack, atk_path: str):
+        """Save atk over atk_path, atomically, then empty the journal of what was saved."""
+        atk.save(atk_path)
+        self.saved()
@@ -0,0 +1,161 @@
+"""
+Compiling reports against a precompiled preamble.
+Loading the document class and packages is most of what pdflatex does for a short document,
+so the preamble is compiled once into a format file:
+  pdflatex -ini -jobname=<key> "&pdflatex <key>.tex\\dump"
+and every report with that preamble is compiled with -fmt=<key>, starting from \\begin{document}.
+Formats are kept by a hash of the compiler's version and the preamble, so changing the packages in
+report.Report.create_document makes a new one, and a cache of its own then removes the old one.
+Where a format can't be built or used the whole document is compiled, preamble and all.
+Reports are compiled in a directory of their own, files they include by relative path are looked for
+in base_dir first through TEXINPUTS, like they were when LaTeX ran in the attack's directory.
+"""
+import glob
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Optional
+
+import pylatex
+
+BEGIN_DOCUMENT = "\\begin{document}"
+RERUN = re.compile(r"(Rerun to get|rerunfilecheck|Label\(s\) may have changed)")
+CLEAN_EXTENSIONS = [".aux", ".log", ".out", ".tex"]
+
+
+class FormatError(Exception):
+    """The compiler couldn't load a format."""
+
+
+def compile_pdf(tex: str, path: str, base_dir: str = None, compiler: str = "pdflatex", fmt: str = None,
+                format_dir: str = None):
+    """
+    Compile the LaTeX tex to path.pdf, in path's directory, with the format fmt from format_dir if given.
+    Raises subprocess.CalledProcessError when the LaTeX is invalid, FileNotFoundError without the compiler.
+    """
+    path = os.path.abspath(path)
+    directory, name = os.path.split(path)
+    with open(path + ".tex", "w", encoding="UTF-8") as f:
+        f.write(tex)
+    # An empty entry keeps the usual search path after the directory given.
+    env = dict(os.environ)
+    if base_dir is not None:
+        env["TEXINPUTS"] = os.path.abspath(base_dir) + os.pathsep + env.get("TEXINPUTS", "")
+    command = [compiler, "-interaction=nonstopmode", name + ".tex"]
+    if fmt is not None:
+        env["TEXFORMATS"] = format_dir + os.pathsep
+        command.insert(2, f"-fmt={fmt}")
+    try:
+        for _ in range(3):  # Again while references change, like pylatex's lastpage.
+            result = subprocess.run(command, cwd=directory, env=env, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = result.stdout.decode(errors="replace")
+            if result.returncode != 0:
+                if fmt is not None and "format file" in output:  # Not the report's fault.
+                    raise FormatError(fmt)
+                raise subprocess.CalledProcessError(result.returncode, command, result.stdout)
+            if not RERUN.search(output):
+                break
+    finally:
+        for extension in CLEAN_EXTENSIONS:
+            remove(path + extension)
+
+
+def generate_pdf(document: pylatex.Document, path: str, base_dir: str = None, compiler: str = "pdflatex"):
+    """Compile document to path.pdf without a format, see compile_pdf."""
+    compile_pdf(document.dumps(), path, base_dir, compiler)
+
+
+def split_preamble(document: pylatex.Document) -> tuple[str, str]:
+    """The LaTeX of document, as the preamble and everything from \\begin{document} on."""
+    text = document.dumps()
+    idx = text.index(BEGIN_DOCUMENT)
+    return text[:idx], text[idx:]
+
+
+class FormatCache:
+    """
+    Format files in directory, a temp directory removed by close if not given.
+    Processes can share a directory, each format is built to a name of its own and renamed into place.
+    """
+    def __init__(self, directory: str = None, compiler: str = "pdflatex"):
+        self.owned = directory is None
+        self.directory = tempfile.mkdtemp(prefix="apt_fmt_") if directory is None else directory
+        self.compiler = compiler
+        self.lock = threading.Lock()
+        self.version: Optional[str] = None
+        self.failed: set[str] = set()  # Formats that couldn't be built or used, not tried again.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def available(self) -> bool:
+        return shutil.which(self.compiler) is not None
+
+    def key(self, preamble: str) -> str:
+        if self.version is None:
+            try:
+                self.version = subprocess.run([self.compiler, "--version"], capture_output=True, text=True,
+                                              errors="replace").stdout.partition("\n")[0]
+            except OSError:
+                self.version = ""
+        return "apt_" + hashlib.sha256((self.version + "\0" + preamble).encode()).hexdigest()[:16]
+
+    def format_for(self, preamble: str) -> Optional[str]:
+        """Name of the format for preamble, built if it isn't yet. None if it can't be built."""
+        if not self.available():
+            return None
+        key = self.key(preamble)
+        with self.lock:
+            if key in self.failed:
+                return None
+            if os.path.exists(os.path.join(self.directory, key + ".fmt")):
+                return key
+            job = f"{key}_{os.getpid()}_{threading.get_ident()}"
+            with open(os.path.join(self.directory, job + ".tex"), "w", encoding="UTF-8") as f:
+                f.write(preamble)
+            result = subprocess.run([self.compiler, "-ini", "-interaction=nonstopmode", f"-jobname={job}",
+                                     f"&{self.compiler} {job}.tex\\dump"],
+                                    cwd=self.directory, stdin=subprocess.DEVNULL, capture_output=True)
+            for extension in (".tex", ".log"):
+                remove(os.path.join(self.directory, job + extension))
+            if result.returncode != 0 or not os.path.exists(os.path.join(self.directory, job + ".fmt")):
+                self.failed.add(key)
+                return None
+            os.replace(os.path.join(self.directory, job + ".fmt"), os.path.join(self.directory, key + ".fmt"))
+            if self.owned:  # Nobody else uses the formats built for the preamble before.
+                for stale in glob.glob(os.path.join(self.directory, "apt_*.fmt")):
+                    if os.path.basename(stale) != key + ".fmt":
+                        remove(stale)
+            return key
+
+    def generate_pdf(self, document: pylatex.Document, path: str, base_dir: str = None):
+        """Same as the module's generate_pdf, with the format when there is one."""
+        preamble, body = split_preamble(document)
+        key = self.format_for(preamble)
+        if key is not None:
+            try:
+                compile_pdf(body, path, base_dir, self.compiler, key, self.directory)
+                return
+            except FormatError:
+                with self.lock:
+                    self.failed.add(key)
+        generate_pdf(document, path, base_dir, self.compiler)
+
+
+def remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,156 @@
+"""
+Loading big JSON .atk files without decoding their output.
+The file is mapped into memory and only skipped through, value by value, to find where things are.
+Meta, script, document and variables are small and decoded as usual,
+every stdout and stderr is left in the file and read from its offsets the first time it is used.
+"""
+import json
+import mmap
+import os
+import re
+
+import attack
+
+LAZY_SIZE = 4 * 1024 * 1024  # Files smaller than this are just decoded.
+
+WHITESPACE = re.compile(rb"[ \t\r\n]*")
+LITERAL = re.compile(rb"[^ \t\r\n,:\[\]{}]+")
+STRUCTURE = re.compile(rb'["\[\]{}]')
+
+
+class FileBlob(attack.Blob):
+    """A JSON string in a file, by its byte offsets, read the first time it is used."""
+    def __init__(self, path: str, start: int, end: int, stamp: tuple[int, int]):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.stamp = stamp  # Size and modification time of the file when the offsets were found.
+
+    def read(self) -> str:
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != self.stamp:
+                raise OSError(f"{self.path} changed since the attack was loaded, its output can't be read.")
+            f.seek(self.start)
+            return json.loads(f.read(self.end - self.start))
+
+    def size(self) -> int:
+        return self.end - self.start
+
+
+def skip_whitespace(buf, pos: int) -> int:
+    return WHITESPACE.match(buf, pos).end()
+
+
+def skip_string(buf, pos: int) -> int:
+    """End of the string starting at pos, found with find rather than a regex, which is far slower on long strings."""
+    end = pos + 1
+    while True:
+        end = buf.find(b'"', end)
+        if end < 0:
+            raise ValueError("JSON ended in a string")
+        backslash = end
+        while buf[backslash - 1] == 0x5C:
+            backslash -= 1
+        if (end - backslash) % 2 == 0:  # Not escaped.
+            return end + 1
+        end += 1
+
+
+def skip_value(buf, pos: int) -> tuple[int, int]:
+    """Start and end of the value at pos."""
+    pos = skip_whitespace(buf, pos)
+    first = buf[pos:pos + 1]
+    if first == b'"':
+        return pos, skip_string(buf, pos)
+    if first not in (b"{", b"["):
+        match = LITERAL.match(buf, pos)
+        if match is None:
+            raise ValueError(f"Invalid JSON at byte {pos}")
+        return pos, match.end()
+    depth = 0
+    end = pos
+    while True:
+        match = STRUCTURE.search(buf, end)
+        if match is None:
+            raise ValueError("JSON ended early")
+        token = match.group()
+        end = match.end()
+        if token == b'"':
+            end = skip_string(buf, match.start())  # Brackets in strings don't count.
+        elif token in (b"{", b"["):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos, end
+
+
+def expect(buf, pos: int, char: bytes) -> int:
+    pos = skip_whitespace(buf, pos)
+    if buf[pos:pos + 1] != char:
+        raise ValueError(f"Expected {char.decode()} at byte {pos}")
+    return pos + 1
+
+
+def scan_object(buf, start: int) -> dict[str, tuple[int, int]]:
+    """Start and end of each value of the object at start, by key."""
+    values = {}
+    pos = expect(buf, start, b"{")
+    if buf[skip_whitespace(buf, pos):skip_whitespace(buf, pos) + 1] == b"}":
+        return values
+    while True:
+        key_start, key_end = skip_value(buf, pos)
+        pos = expect(buf, key_end, b":")
+        values[json.loads(buf[key_start:key_end])] = span = skip_value(buf, pos)
+        pos = skip_whitespace(buf, span[1])
+        if buf[pos:pos + 1] == b"}":
+            return values
+        pos = expect(buf, pos, b",")
+
+
+def scan_array(buf, start: int) -> list[tuple[int, int]]:
+    """Start and end of each value of the array at start."""
+    values = []
+    pos = expect(buf, start, b"[")
+    if buf[skip_whitespace(buf, pos):skip_whitespace(buf, pos) + 1] == b"]":
+        return values
+    while True:
+        values.append(skip_value(buf, pos))
+        pos = skip_whitespace(buf, values[-1][1])
+        if buf[pos:pos + 1] == b"]":
+            return values
+        pos = expect(buf, pos, b",")
+
+
+def read_output(buf, start: int, path: str, stamp: tuple[int, int]) -> attack.Output:
+    sections = []
+    for section_start, _ in scan_array(buf, scan_object(buf, start)["sections"][0]):
+        fields = scan_object(buf, section_start)
+        stats = attack.SectionStats.from_dict(json.loads(buf[slice(*fields["stats"])])) if "stats" in fields else None
+        sections.append(attack.SectionOutput(json.loads(buf[slice(*fields["id"])]),
+                                             FileBlob(path, *fields["stdout"], stamp),
+                                             FileBlob(path, *fields["stderr"], stamp),
+                                             stats))
+    return attack.Output(sections)
+
+
+def load(path: str) -> attack.Attack:
+    """Load a JSON .atk, leaving its output in the file until it is used."""
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size < LAZY_SIZE:
+            return attack.Attack.from_json(f.read().decode("UTF-8"))
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            fields = scan_object(buf, 0)
+            head = {key: json.loads(buf[start:end]) for key, (start, end) in fields.items()
+                    if key not in ("output", "targets")}
+            atk = attack.Attack.from_dict(head)
+            if "output" in fields:
+                atk.output = read_output(buf, fields["output"][0], path, stamp)
+            if "targets" in fields:
+                for target, (start, _) in scan_object(buf, fields["targets"][0]).items():
+                    # Targets hold the sections straight away, not under "output".
+                    atk.targets[target] = read_output(buf, start, path, stamp)
+    return atk
@@ -0,0 +1,280 @@
+"""
+Reading nmap output into host and port records, so patterns can ask about fields instead of regexing text.
+Both normal output (the default, -oN) and XML output (-oX) are read, see parse.
+Records are kept small: per host its address, hostname, status, os, ports and host scripts,
+per port its number, protocol, state, service, version and scripts.
+
+Patterns starting with "nmap:" are queries on these records, made of terms that all have to hold
+for one port of one host:
+  nmap: port=445 state=open
+  nmap: version~samba
+  nmap: host=192.168.1.5 script=smb-protocols output~SMBv1
+field=value compares the whole field, field~value searches it with a regex, field!=value is the opposite
+of =, all ignoring case. Fields are host, hostname, status, os, port, protocol, state, service, version,
+script and output, script and output also look at host scripts.
+Values with spaces are quoted, 'as is' or "with \\" for a quote":
+  nmap: version~'Samba smbd 3\\.X'
+A query needs at least one term.
+"""
+import io
+import re
+import typing
+import xml.etree.ElementTree as ElementTree
+from typing import Optional
+
+QUERY_PREFIX = "nmap:"
+
+HOST_LINE = re.compile(r"^Nmap scan report for (?:(\S+) \(([^)]+)\)|(\S+))")
+PORT_LINE = re.compile(r"^(\d+)/(tcp|udp|sctp)\s+(\S+)(?:\s+(\S+))?(?:\s+(.*))?$")
+SCRIPT_LINE = re.compile(r"^\|[ _]([^:\s]+):\s?(.*)$")
+
+
+class Script:
+    def __init__(self, script_id: str, output: str):
+        self.script_id = script_id
+        self.output = output
+
+    def to_dict(self) -> dict:
+        return {"id": self.script_id, "output": self.output}
+
+    @classmethod
+    def from_dict(cls, in_dict: dict):
+        return cls(in_dict["id"], in_dict["output"])
+
+
+class Port:
+    def __init__(self, port: int, protocol: str, state: str, service: str = "", version: str = "",
+                 scripts: list[Script] = None):
+        self.port = port
+        self.protocol = protocol
+        self.state = state
+        self.service = service
+        self.version = version
+        self.scripts = scripts if scripts is not None else []
+
+    def to_dict(self) -> dict:
+        return {"port": self.port, "protocol": self.protocol, "state": self.state, "service": self.service,
+                "version": self.version, "scripts": [script.to_dict() for script in self.scripts]}
+
+    @classmethod
+    def from_dict(cls, in_dict: dict):
+        return cls(in_dict["port"], in_dict["protocol"], in_dict["state"], in_dict["service"], in_dict["version"],
+                   [Script.from_dict(script) for script in in_dict["scripts"]])
+
+
+class Host:
+    def __init__(self, address: str, hostname: str = "", status: str = "", os: str = "",
+                 ports: list[Port] = None, scripts: list[Script] = None):
+        self.address = address
+        self.hostname = hostname
+        self.status = status
+        self.os = os
+        self.ports = ports if ports is not None else []
+        self.scripts = scripts if scripts is not None else []  # Host script results.
+
+    def to_dict(self) -> dict:
+        return {"address": self.address, "hostname": self.hostname, "status": self.status, "os": self.os,
+                "ports": [port.to_dict() for port in self.ports],
+                "scripts": [script.to_dict() for script in self.scripts]}
+
+    @classmethod
+    def from_dict(cls, in_dict: dict):
+        return cls(in_dict["address"], in_dict["hostname"], in_dict["status"], in_dict["os"],
+                   [Port.from_dict(port) for port in in_dict["ports"]],
+                   [Script.from_dict(script) for script in in_dict["scripts"]])
+
+
+def parse_normal(lines: typing.Iterable[str]) -> list[Host]:
+    hosts: list[Host] = []
+    host: Optional[Host] = None
+    scripts: Optional[list[Script]] = None  # Where script results go, the last port's or the host's.
+    script: Optional[Script] = None  # Script whose output is still going, until a "|_" line.
+    for line in lines:
+        line = line.rstrip()
+        match = HOST_LINE.match(line)
+        if match:
+            if match.group(3):
+                host = Host(match.group(3))
+            else:
+                host = Host(match.group(2), match.group(1))
+            hosts.append(host)
+            scripts, script = None, None
+            continue
+        if host is None:
+            continue
+        if line.startswith("|"):
+            if scripts is None:
+                continue
+            if script is None:
+                match = SCRIPT_LINE.match(line)
+                if match is None:
+                    continue
+                script = Script(match.group(1), match.group(2).strip())
+                scripts.append(script)
+            else:
+                script.output += "\n" + line[2:]
+            if line.startswith("|_"):
+                script.output = script.output.strip()
+                script = None
+            continue
+        script = None
+        match = PORT_LINE.match(line)
+        if match:
+            port = Port(int(match.group(1)), match.group(2), match.group(3), match.group(4) or "",
+                        (match.group(5) or "").strip())
+            host.ports.append(port)
+            scripts = port.scripts
+        elif line.startswith("Host is up"):
+            host.status = "up"
+        elif line.startswith("Host seems down") or line.startswith("Host is down"):
+            host.status = "down"
+        elif line == "Host script results:":
+            scripts = host.scripts
+        elif line.startswith("OS details: ") or (line.startswith("Running: ") and not host.os):
+            host.os = line.partition(": ")[2]
+        else:
+            scripts = None
+    return hosts
+
+
+def parse_xml(f: typing.TextIO) -> list[Host]:
+    hosts = []
+    for _, host_element in ElementTree.iterparse(f):
+        if host_element.tag != "host":
+            continue
+        address = ""
+        for address_element in host_element.findall("address"):
+            if address_element.get("addrtype") != "mac" or not address:  # Rather the ip than the mac.
+                address = address_element.get("addr", "")
+        hostname_element = host_element.find("hostnames/hostname")
+        status_element = host_element.find("status")
+        os_element = host_element.find("os/osmatch")
+        host = Host(address,
+                    hostname_element.get("name", "") if hostname_element is not None else "",
+                    status_element.get("state", "") if status_element is not None else "",
+                    os_element.get("name", "") if os_element is not None else "")
+        for port_element in host_element.findall("ports/port"):
+            state_element = port_element.find("state")
+            service_element = port_element.find("service")
+            service, version = "", ""
+            if service_element is not None:
+                service = service_element.get("name", "")
+                version = " ".join(service_element.get(name) for name in ("product", "version", "extrainfo")
+                                   if service_element.get(name))
+            host.ports.append(Port(int(port_element.get("portid")),
+                                   port_element.get("protocol", ""),
+                                   state_element.get("state", "") if state_element is not None else "",
+                                   service,
+                                   version,
+                                   [Script(script.get("id", ""), script.get("output", "").strip())
+                                    for script in port_element.findall("script")]))
+        for script in host_element.findall("hostscript/script"):
+            host.scripts.append(Script(script.get("id", ""), script.get("output", "").strip()))
+        hosts.append(host)
+        host_element.clear()  # Done with it, big scans don't have to fit in memory as a tree.
+    return hosts
+
+
+def parse_file(f: typing.TextIO) -> list[Host]:
+    """Hosts in nmap normal or XML output read from f, an empty list for anything else."""
+    start = f.read(512).lstrip()
+    f.seek(0)
+    if start.startswith("<?xml") or "<nmaprun" in start:
+        try:
+            return parse_xml(f)
+        except ElementTree.ParseError:  # Cut short, maybe by a killed scan. Nothing to go on.
+            return []
+    return parse_normal(f)
+
+
+def parse(text: str) -> list[Host]:
+    return parse_file(io.StringIO(text))
+
+
+class Term:
+    host_fields = {"host", "hostname", "status", "os"}
+    port_fields = {"port", "protocol", "state", "service", "version"}
+    script_fields = {"script", "output"}
+
+    def __init__(self, field: str, operator: str, value: str):
+        if field not in self.host_fields | self.port_fields | self.script_fields:
+            raise ValueError(f"Unknown nmap field: {field}")
+        self.field = field
+        self.operator = operator
+        self.value = value.lower()
+        self.regex = re.compile(value, re.IGNORECASE) if operator == "~" else None
+
+    def test(self, value: str) -> bool:
+        if self.operator == "~":
+            return self.regex.search(value) is not None
+        return (value.lower() == self.value) == (self.operator == "=")
+
+    def holds(self, host: Host, port: Optional[Port]) -> bool:
+        if self.field == "host":
+            if self.operator == "!=":  # Neither the address nor the hostname may match.
+                return self.test(host.address) and self.test(host.hostname)
+            return self.test(host.address) or self.test(host.hostname)
+        if self.field in self.host_fields:
+            return self.test(getattr(host, self.field))
+        if self.field in self.port_fields:
+            return port is not None and self.test(str(getattr(port, self.field)))
+        return False  # Script fields are checked together, see Query.
+
+
+class Query:
+    """A pattern_str starting with nmap:, see the top of this file."""
+    term_re = re.compile(r"""(\w+)(!=|=|~)("(?:[^"\\]|\\.)*"|'[^']*'|[^\s"']\S*|)(?=\s|$)""")
+
+    def __init__(self, terms: list[Term]):
+        self.terms = terms
+        self.script_terms = [term for term in terms if term.field in Term.script_fields]
+        self.other_terms = [term for term in terms if term.field not in Term.script_fields]
+
+    @staticmethod
+    def is_query(pattern_str: str) -> bool:
+        return pattern_str.lstrip().startswith(QUERY_PREFIX)
+
+    @classmethod
+    def parse(cls, pattern_str: str):
+        """Raises ValueError for a query that can't be read."""
+        terms = []
+        text = pattern_str.lstrip()[len(QUERY_PREFIX):]
+        pos = 0
+        while True:
+            pos = len(text) - len(text[pos:].lstrip())
+            if pos == len(text):
+                break
+            match = cls.term_re.match(text, pos)
+            if match is None:
+                raise ValueError(f"nmap query terms look like field=value, got: {text[pos:].split()[0]}")
+            field, operator, value = match.groups()
+            if value[:1] == "'":
+                value = value[1:-1]
+            elif value[:1] == '"':
+                value = value[1:-1].replace('\\"', '"')
+            try:
+                terms.append(Term(field, operator, value))
+            except re.error as e:
+                raise ValueError(f"Invalid regex in nmap query: {match.group()} ({e})")
+            pos = match.end()
+        if not terms:
+            raise ValueError("nmap query has no terms, like nmap: port=445 state=open")
+        return cls(terms)
+
+    def scripts_hold(self, scripts: list[Script]) -> bool:
+        for script in scripts:
+            if all(term.test(script.script_id if term.field == "script" else script.output)
+                   for term in self.script_terms):
+                return True
+        return False
+
+    def matches(self, hosts: list[Host]) -> bool:
+        for host in hosts:
+            for port in host.ports + [None]:  # None stands for the host itself.
+                if not all(term.holds(host, port) for term in self.other_terms):
+                    continue
+                if not self.script_terms:
+                    return True
+                if self.scripts_hold(port.scripts if port is not None else host.scripts):
+                    return True
+        return False
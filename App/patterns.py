@@ -0,0 +1,106 @@
+"""
+Matching the patterns of document sections against section output.
+Every pattern of a section is tried in one pass over the output, instead of one search per pattern.
+The patterns are joined into a single alternation, (?:...)|(?:...), so the regex engine tries all
+of them at each position while walking the output once. Where it stops, the patterns that match
+there are found by trying each one at that position, then the walk goes on without them.
+Patterns that can't be joined, like ones with backreferences, are searched on their own.
+Patterns starting with "nmap:" are queries on the hosts read from the output, see nmap_parse.py.
+Regexes search stdout as one string, so output kept on disk (see store.py) is read whole for them,
+only nmap queries go through it in pieces.
+"""
+import functools
+import re
+
+try:
+    from re import _parser as sre_parse  # Python 3.11 on.
+except ImportError:
+    import sre_parse
+
+import attack
+import nmap_parse
+
+
+@functools.lru_cache(maxsize=256)
+def combined_regex(pattern_strs: tuple[str, ...]) -> re.Pattern:
+    """One regex matching wherever any of pattern_strs matches."""
+    return re.compile("|".join(f"(?:{pattern_str})" for pattern_str in pattern_strs))
+
+
+def refers_to_group(value) -> bool:
+    """Whether a parsed regex, or part of one, has a group reference in it."""
+    if isinstance(value, sre_parse.SubPattern):
+        for op, argument in value:
+            if op.name.startswith("GROUPREF") or refers_to_group(argument):  # \1, (?P=name), (?(1)yes|no).
+                return True
+    elif isinstance(value, (list, tuple)):  # Arguments of branches, groups and repeats.
+        return any(refers_to_group(part) for part in value)
+    return False
+
+
+@functools.lru_cache(maxsize=1024)
+def has_group_reference(pattern_str: str) -> bool:
+    try:
+        return refers_to_group(sre_parse.parse(pattern_str))
+    except re.error:
+        return True  # Searched on its own, which reports the error.
+
+
+def can_combine(pattern: attack.Pattern) -> bool:
+    # References count groups from the start of the regex, joining patterns would point them at other patterns.
+    return not has_group_reference(pattern.pattern_str)
+
+
+def search_combined(patterns: list[attack.Pattern], text: str) -> set[int]:
+    """Indexes of the patterns found in text, raises re.error if they can't be joined."""
+    found = set()
+    remaining = list(range(len(patterns)))
+    pos = 0
+    while remaining:
+        regex = combined_regex(tuple(patterns[i].pattern_str for i in remaining))
+        match = regex.search(text, pos)
+        if match is None:
+            break
+        start = match.start()
+        # The alternation only says something matched here, find out which.
+        hits = {i for i in remaining if patterns[i].compiled.match(text, start)}
+        found |= hits
+        remaining = [i for i in remaining if i not in hits]
+        pos = start + 1  # Found patterns are left out from here on, so matches of them are not revisited.
+        if pos > len(text):
+            break
+    return found
+
+
+def matching_patterns(patterns: list[attack.Pattern], output: attack.SectionOutput) -> list[attack.Pattern]:
+    """The patterns found in the output, in the order given, same as re.search on the stdout of each of them."""
+    key = tuple(pattern.pattern_str for pattern in patterns)
+    matches = output.matches  # Taken first, setting stdout while searching starts a new one.
+    found = matches.get(key)
+    if found is None:
+        found = find_patterns(patterns, output)
+        while len(matches) >= output.max_matches:
+            matches.pop(next(iter(matches)), None)  # The oldest.
+        matches[key] = found
+    return [patterns[i] for i in found]
+
+
+def find_patterns(patterns: list[attack.Pattern], output: attack.SectionOutput) -> list[int]:
+    """Indices of the patterns found in the output, without the cache of matching_patterns."""
+    text = output.stdout
+    queries = [pattern for pattern in patterns if nmap_parse.Query.is_query(pattern.pattern_str)]
+    regexes = [pattern for pattern in patterns if not nmap_parse.Query.is_query(pattern.pattern_str)]
+    for pattern in regexes:
+        pattern.compiled  # Raises re.error for an invalid pattern, like re.search would.
+    combinable = [pattern for pattern in regexes if can_combine(pattern)]
+    found = set()
+    if len(combinable) > 1:
+        try:
+            found = {id(combinable[i]) for i in search_combined(combinable, text)}
+        except re.error:  # Global flags or repeated group names, fall back to one search each.
+            found = {id(pattern) for pattern in combinable if pattern.compiled.search(text)}
+    else:
+        found = {id(pattern) for pattern in combinable if pattern.compiled.search(text)}
+    found |= {id(pattern) for pattern in regexes if not can_combine(pattern) and pattern.compiled.search(text)}
+    found |= {id(pattern) for pattern in queries if nmap_parse.Query.parse(pattern.pattern_str).matches(output.hosts)}
+    return [i for i, pattern in enumerate(patterns) if id(pattern) in found]
@@ -1,13 +1,13 @@
 
 rem save current vars
-set > cv
+set > "%APT_TAG%cv"
 
 rem remove ignored vars
-diff.exe -n iv cv > dv
+diff.exe -n "%APT_TAG%iv" "%APT_TAG%cv" > "%APT_TAG%dv"
 
 set other=1
 
-for /f "tokens=*" %%a in (dv) do call :exportv %%a
+for /f "usebackq tokens=*" %%a in ("%APT_TAG%dv") do call :exportv %%a
 
 goto :cleanup
 
@@ -16,13 +16,13 @@ if [%other%]==[1] (
   set other=
   goto :eof
 )
-echo %* >> nv
+echo %* >> "%APT_TAG%nv"
 set other=1
 goto :eof
 
 :cleanup
-del iv
-del dv
-del cv
+del "%APT_TAG%iv"
+del "%APT_TAG%dv"
+del "%APT_TAG%cv"
 
 :eof
\ No newline at end of file
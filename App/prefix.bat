@@ -1,9 +1,10 @@
 @echo off
+rem APT_TAG is set by APT so sections running side by side use their own files.
 rem save vars to ignore
-set > iv
+set > "%APT_TAG%iv"
 rem import new vars
-for /f "tokens=*" %%a in (nv) do call :importv %%a
-del nv
+for /f "usebackq tokens=*" %%a in ("%APT_TAG%nv") do call :importv %%a
+del "%APT_TAG%nv"
 goto :attack
 
 :importv
@@ -0,0 +1,76 @@
+"""
+Rasterizing report previews, without any of the ui.
+Pages are rendered to raw RGB samples that the ui wraps in a QImage as they are,
+instead of encoding each page to an image format and decoding it again.
+The page being looked at is rendered first and handed over before the rest,
+rendered pages are cached by the hash of the pdf and the zoom so an unchanged preview renders nothing.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import fitz
+
+
+class RasterPage:
+    """One rendered page, samples are RGB888 rows of stride bytes each."""
+    def __init__(self, width: int, height: int, stride: int, samples: bytes):
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.samples = samples
+
+
+class PageCache:
+    """Rendered pages by (pdf hash, zoom, page number), the least recently used pages are dropped first."""
+    def __init__(self, max_pages: int = 256):
+        self.pages: OrderedDict[tuple[str, float, int], RasterPage] = OrderedDict()
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple[str, float, int]) -> Optional[RasterPage]:
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def put(self, key: tuple[str, float, int], page: RasterPage):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+
+def render_page(page: fitz.Page, zoom: float = 1.0) -> RasterPage:
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return RasterPage(pix.width, pix.height, pix.stride, pix.samples)
+
+
+def rasterize(path: str, on_page: Callable[[int, int, RasterPage], None], zoom: float = 1.0, first: int = 0,
+              cache: PageCache = None, proceed: Callable[[], bool] = lambda: True) -> int:
+    """
+    Render the pages of the pdf at path, page first before any other and the rest in order.
+    on_page is called with (page number, page count, page) as each page is ready.
+    proceed is checked before each page, returning False stops rendering.
+    Returns the page count.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    pdf_hash = hashlib.sha256(data).hexdigest()
+    with fitz.open(stream=data, filetype="pdf") as document:
+        count = document.page_count
+        first = first if 0 <= first < count else 0
+        for number in [first] + [i for i in range(count) if i != first]:
+            if not proceed():  # Exit-point
+                break
+            key = (pdf_hash, zoom, number)
+            page = cache.get(key) if cache is not None else None
+            if page is None:
+                page = render_page(document[number], zoom)
+                if cache is not None:
+                    cache.put(key, page)
+            on_page(number, count, page)
+    return count
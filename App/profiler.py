@@ -0,0 +1,86 @@
+"""
+Timing where report generation spends its time.
+A Profiler records spans, each a named phase with a start, a duration and some details:
+  report, preview: A whole build of a pdf, around everything below but rasterize.
+  target: The sections of one target, in a report for every target.
+  section: One SectionDocument, details say which and whether its LaTeX came from the cache.
+  patterns: Matching a section's patterns against its output.
+  pylatex: Building a section's LaTeX with pylatex.
+  latex: The LaTeX compiler, run by generate_pdf.
+  rasterize: Turning the preview pdf into images with fitz.
+Spans of one phase inside another (patterns inside section) count towards both.
+export writes them as JSON, or in the trace event format for chrome://tracing and Perfetto
+when the file name ends in .trace.json.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+import attack
+
+PHASES = ["patterns", "pylatex", "latex", "rasterize"]  # The phases summary reports, in the order they happen.
+
+
+class Span:
+    def __init__(self, name: str, start: float, duration: float, thread: int, details: dict):
+        self.name = name
+        self.start = start  # Seconds since the profiler was made.
+        self.duration = duration
+        self.thread = thread
+        self.details = details
+
+    def to_dict(self) -> dict:
+        return {"phase": self.name, "start": self.start, "duration": self.duration} | self.details
+
+
+class Profiler:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, /, **details):
+        start = time.perf_counter()
+        try:
+            yield details  # Details can still be filled in, like whether a section was cached.
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.spans.append(Span(name, start - self.origin, end - start, threading.get_ident(), details))
+
+    def totals(self) -> dict[str, float]:
+        """Seconds spent in each phase."""
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def summary(self) -> str:
+        totals = self.totals()
+        return ", ".join(f"{phase} {totals[phase]:.2f}s" for phase in PHASES if phase in totals)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {"totals": self.totals(), "spans": [span.to_dict() for span in spans]}
+
+    def to_trace(self) -> dict:
+        """Complete ("X") trace events, times in microseconds."""
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for span in spans:
+            events.append({"name": span.name, "cat": "report", "ph": "X", "ts": span.start * 1e6,
+                           "dur": span.duration * 1e6, "pid": os.getpid(),
+                           "tid": threads.setdefault(span.thread, len(threads)), "args": span.details})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str):
+        data = self.to_trace() if path.endswith(".trace.json") else self.to_dict()
+        with attack.atomic_file(path) as f:
+            f.write(json.dumps(data, indent=1).encode("UTF-8"))
@@ -0,0 +1,244 @@
+"""
+Building reports from an attack with pylatex, without any of the ui.
+Used by the DocumentWorker in the ui and by the command line runner.
+Sections are rendered to LaTeX fragments that are cached by everything that goes into them,
+so rebuilding a report only renders the sections that changed and skips LaTeX when none did.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import pylatex
+from pylatex import NoEscape
+
+import attack
+import latex
+import patterns
+import profiler
+
+
+class EndDocumentException(Exception):
+    def __init__(self, message="Document generation is ending early. Likely due to a pattern with END behavior."):
+        self.message = message
+
+
+class PatternErrorException(Exception):
+    def __init__(self,
+                 message="Document generation failed because an ERROR pattern matched, check your attack output."):
+        self.message = message
+
+
+class LatexException(Exception):
+    def __init__(self, message="Document generation failed, the LaTeX was invalid.", invalid_latex: str = ""):
+        self.message = message
+        self.invalid_latex = invalid_latex
+
+
+class ReportCache:
+    """
+    Rendered LaTeX of sections by section key, and the key of the last build of each report.
+    Meant to be kept for as long as the attack is open and shared by every report built from it.
+    """
+    def __init__(self, max_fragments: int = 4096):
+        self.fragments: OrderedDict[str, str] = OrderedDict()
+        self.reports: dict[str, str] = {}  # Absolute path of a report to the key it was last built with.
+        self.max_fragments = max_fragments
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+            return fragment
+
+    def put(self, key: str, fragment: str):
+        with self.lock:
+            self.fragments[key] = fragment
+            self.fragments.move_to_end(key)
+            while len(self.fragments) > self.max_fragments:
+                self.fragments.popitem(last=False)
+
+
+class Report:
+    def __init__(self, atk: attack.Attack, cache: ReportCache = None, profile: profiler.Profiler = None,
+                 formats: latex.FormatCache = None, base_dir: str = None):
+        self.atk = atk
+        self.cache = cache
+        self.profile = profile  # Records where the time goes, if given.
+        self.formats = formats  # Precompiled preambles to compile with, if given.
+        self.base_dir = base_dir  # Reference sections are relative to it, usually the atk dir.
+
+    def span(self, name: str, /, **details):
+        return self.profile.span(name, **details) if self.profile is not None else contextlib.nullcontext(details)
+
+    def path(self, name: str) -> str:
+        return name if self.base_dir is None else os.path.join(self.base_dir, name)
+
+    def get_matching_patterns(self, doc_section_id: int, atk: attack.Attack = None) -> list[attack.Pattern]:
+        atk = self.atk if atk is None else atk
+        output_section = atk.output.get_section(doc_section_id)
+        doc_section = atk.document.get_section(doc_section_id)
+        with self.span("patterns", id=doc_section_id):
+            return patterns.matching_patterns(doc_section.patterns, output_section)
+
+    def section_key(self, section: attack.SectionDocument, matching: list[attack.Pattern], level: type) -> str:
+        """Hash of everything the rendered section depends on."""
+        parts = [section.section_type.value, section.name, section.content,
+                 [pattern.to_dict() for pattern in section.patterns],
+                 [i for i, pattern in enumerate(section.patterns) if pattern in matching],
+                 level.__name__]
+        if section.section_type is attack.DocumentSectionType.REFERENCE:
+            try:
+                with open(self.path(section.content), "r") as f:
+                    parts.append(f.read())
+            except OSError:
+                pass  # create_section reports it.
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def render_section(self, document_section_id: int, atk: attack.Attack = None,
+                       level: type = pylatex.Section) -> str:
+        """The LaTeX of one section, from the cache when nothing it depends on changed."""
+        atk = self.atk if atk is None else atk
+        section = atk.document.get_section(document_section_id)
+        with self.span("section", id=document_section_id, title=section.name, cached=False) as details:
+            matching = []
+            if section.section_type is attack.DocumentSectionType.PATTERN:
+                matching = self.get_matching_patterns(document_section_id, atk)
+            key = self.section_key(section, matching, level)
+            if self.cache is not None:
+                fragment = self.cache.get(key)
+                if fragment is not None:
+                    details["cached"] = True
+                    return fragment
+            with self.span("pylatex", id=document_section_id):
+                scratch = pylatex.Document()  # Only used to hold the section.
+                self.create_section(scratch, document_section_id, atk, level, matching)
+                fragment = "%\n".join(item.dumps() for item in scratch.data)
+            if self.cache is not None:
+                self.cache.put(key, fragment)
+            return fragment
+
+    def create_section(self, doc: pylatex.Document, document_section_id: int, atk: attack.Attack = None,
+                       level: type = pylatex.Section, matching: list[attack.Pattern] = None):
+        atk = self.atk if atk is None else atk
+        section = atk.document.get_section(document_section_id)
+        remove_section = False
+
+        with doc.create(level(section.name)):
+            if section.section_type is attack.DocumentSectionType.REFERENCE:
+                with open(self.path(section.content), "r") as f:
+                    doc.append(NoEscape(f.read()))
+            elif section.section_type is attack.DocumentSectionType.LITERAL:
+                doc.append(NoEscape(section.content))
+            elif section.section_type is attack.DocumentSectionType.PATTERN:
+                if matching is None:
+                    matching = self.get_matching_patterns(document_section_id, atk)
+                to_add = NoEscape(section.content)  # I want a copy of the content string.
+                for match in matching:
+                    if match.behavior is attack.PatternBehavior.ADD:
+                        to_add = NoEscape(str(to_add) + match.match_content)
+                    elif match.behavior is attack.PatternBehavior.REPLACE:
+                        to_add = NoEscape(match.match_content)
+                    elif match.behavior is attack.PatternBehavior.REMOVE:
+                        remove_section = True
+                    elif match.behavior is attack.PatternBehavior.END:
+                        raise EndDocumentException()
+                    elif match.behavior is attack.PatternBehavior.ERROR:
+                        raise PatternErrorException()
+                doc.append(to_add)
+            elif section.section_type is attack.DocumentSectionType.COMBINED:
+                pass  # This one is complicated, might work on it later.
+        if remove_section:
+            doc.pop(-1)
+
+    @staticmethod
+    def create_document() -> pylatex.Document:
+        document = pylatex.Document()
+        pkgs = [pylatex.Package("listings")]
+        [document.packages.append(x) for x in pkgs]
+        return document
+
+    def build(self, path: str, fragments: list[str]) -> bool:
+        """
+        Build the pdf at path from rendered sections.
+        LaTeX runs in a scratch directory of its own, only the pdf is moved to path, so builds to the same path
+        don't trip over each other's .tex and .aux files.
+        Returns False if the same report was already built there, then nothing is done.
+        """
+        document = self.create_document()
+        key = hashlib.sha256("%\n".join([document.dumps()] + fragments).encode()).hexdigest()
+        report_path = os.path.abspath(path)
+        if self.cache is not None and self.cache.reports.get(report_path) == key and \
+                os.path.exists(report_path + ".pdf"):
+            return False
+        for fragment in fragments:
+            if fragment:  # Removed sections render to nothing.
+                document.append(NoEscape(fragment))
+        # Next to the report, so the pdf can be renamed into place.
+        with tempfile.TemporaryDirectory(prefix=".apt_job_", dir=os.path.dirname(report_path)) as scratch:
+            scratch_path = os.path.join(scratch, os.path.basename(report_path))
+            try:
+                with self.span("latex"):
+                    if self.formats is not None:
+                        self.formats.generate_pdf(document, scratch_path, self.base_dir)
+                    else:
+                        latex.generate_pdf(document, scratch_path, self.base_dir)
+            except subprocess.CalledProcessError as e:
+                print(e.stdout, e.stderr)
+                raise LatexException()
+            except FileNotFoundError:
+                raise LatexException("Document generation failed, pdflatex wasn't found.")
+            os.replace(scratch_path + ".pdf", report_path + ".pdf")
+        if self.cache is not None:
+            self.cache.reports[report_path] = key
+        return True
+
+    def create_section_preview(self, path: str, section_id: int) -> bool:
+        with self.span("preview", id=section_id):
+            return self.build(path, [self.render_section(section_id)])
+
+    def create_report(self, path: str) -> bool:
+        with self.span("report"):
+            return self.build(path, [self.render_section(section.section_id)
+                                     for section in self.atk.document.sections])
+
+    def create_targets_report(self, path: str) -> bool:
+        with self.span("report", targets=len(self.atk.targets)):
+            fragments = []
+            for target in self.atk.targets:
+                target_atk = self.atk.for_target(target)
+                target_section = pylatex.Section(f"Target: {target}")
+                with self.span("target", target=target):
+                    for section in self.atk.document.sections:
+                        target_section.append(NoEscape(self.render_section(section.section_id, target_atk,
+                                                                           pylatex.Subsection)))
+                fragments.append(target_section.dumps())
+            return self.build(path, fragments)
+
+
+def create_reports(atk: attack.Attack, path: str, per_target: bool = False, cache: ReportCache = None,
+                   profile: profiler.Profiler = None, formats: latex.FormatCache = None,
+                   base_dir: str = None) -> list[str]:
+    """
+    The reports of an attack, like the command line makes them: one at path, or with targets
+    one per target at path_<target> unless per_target puts them all in one. Returns the pdfs written.
+    base_dir is what reference sections are relative to, see Report.
+    """
+    if not atk.targets:
+        Report(atk, cache, profile, formats, base_dir).create_report(path)
+        return [path + ".pdf"]
+    if per_target:
+        Report(atk, cache, profile, formats, base_dir).create_targets_report(path)
+        return [path + ".pdf"]
+    written = []
+    for target in atk.targets:
+        Report(atk.for_target(target), cache, profile, formats, base_dir).create_report(f"{path}_{target}")
+        written.append(f"{path}_{target}.pdf")
+    return written
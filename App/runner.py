@@ -0,0 +1,502 @@
+"""
+Running script sections without waiting on their whole output.
+Child pipes are read incrementally so output can be shown while a section runs,
+captured output is kept in buffers that move to a temp file once they get large, where it then stays.
+Sections are scheduled by their dependencies, independent sections run side by side.
+A whole script can be run against many targets at once, one worker process per target.
+"""
+import codecs
+import io
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Optional, TextIO, Union
+
+import attack
+import store
+
+CHUNK_SIZE = 64 * 1024  # Most bytes read from a pipe at once.
+SPOOL_SIZE = 4 * 1024 * 1024  # Characters kept in memory before a buffer is moved to disk.
+MEMORY_INTERVAL = 0.05  # Seconds between samples of a section's memory.
+CANCEL_POLL = 0.1  # Seconds between checks whether a run against many targets was cancelled.
+
+target_cancel = None  # In worker processes of run_targets, set once the whole run is cancelled.
+
+
+class OutputBuffer:
+    """
+    Bounded buffer for one stream of a child process.
+    Bytes are decoded as they arrive, text over max_memory is moved to a temp file instead of memory.
+    """
+    def __init__(self, encoding: str = "UTF-8", max_memory: int = SPOOL_SIZE):
+        self.encoding = encoding
+        self.max_memory = max_memory
+        self.file: TextIO = io.StringIO(newline="")
+        self.path: Optional[str] = None  # The temp file, once the text was moved there.
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.size = 0  # Bytes written, before decoding.
+
+    def spill(self):
+        fd, self.path = tempfile.mkstemp(suffix=".out")
+        spilled = open(fd, "w+", encoding=self.encoding, newline="")
+        spilled.write(self.file.getvalue())
+        self.file = spilled
+
+    def put(self, text: str):
+        self.file.write(text)
+        if self.path is None and self.file.tell() > self.max_memory:
+            self.spill()
+
+    def write(self, data: bytes) -> str:
+        self.size += len(data)
+        text = self.decoder.decode(data)
+        self.put(text)
+        return text
+
+    def write_text(self, text: str):
+        self.size += len(text.encode(self.encoding, errors="replace"))
+        self.put(text)
+
+    def finish(self) -> str:
+        text = self.decoder.decode(b"", final=True)
+        self.put(text)
+        return text
+
+    def getvalue(self) -> str:
+        self.file.seek(0)
+        return self.file.read()
+
+    def detach(self) -> Union[str, attack.Blob]:
+        """
+        The text for a SectionOutput, ending the buffer.
+        Text that went to disk stays there, the temp file is handed to a store.SpillBlob.
+        """
+        if self.path is None:
+            text = self.getvalue()
+            self.file.close()
+            return text
+        self.file.close()
+        blob = store.SpillBlob(self.path, self.encoding)
+        self.path = None
+        return blob
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            store.remove(self.path)
+            self.path = None
+
+
+# Children get their own process group, so a section and everything it started can be killed together.
+if os.name == "nt":
+    PROCESS_GROUP = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    PROCESS_GROUP = {"start_new_session": True}
+
+
+def kill_tree(proc: subprocess.Popen):
+    """Kill proc and every process it started."""
+    if proc.returncode is not None:  # Not poll, stream_process may be waiting on it in another thread.
+        return
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+class RunControl:
+    """
+    Pausing, resuming and cancelling a run, shared by the thread driving it and the sections running.
+    Pausing holds off new sections, cancelling also kills the process trees of the running ones.
+    timeout is the default most seconds a section may run, a section's own timeout goes first.
+    """
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.paused = False
+        self.cancelled = False
+        self.processes: set[subprocess.Popen] = set()
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+            running = list(self.processes)
+        for proc in running:
+            kill_tree(proc)
+
+    def wait_resumed(self) -> bool:
+        """Block while paused, without spinning. Returns False once cancelled."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.paused or self.cancelled)
+            return not self.cancelled
+
+    def add_process(self, proc: subprocess.Popen):
+        with self.condition:
+            self.processes.add(proc)
+            cancelled = self.cancelled
+        if cancelled:  # Cancelled while it was starting.
+            kill_tree(proc)
+
+    def remove_process(self, proc: subprocess.Popen):
+        with self.condition:
+            self.processes.discard(proc)
+
+    def section_timeout(self, section: attack.SectionScript) -> Optional[float]:
+        return section.timeout if section.timeout else self.timeout
+
+
+def wait_usage(proc: subprocess.Popen) -> Optional[float]:
+    """
+    Wait for proc to exit. Returns the cpu seconds of it and the children it waited for,
+    None where the platform doesn't report them.
+    """
+    if not hasattr(os, "wait4"):
+        proc.wait()
+        return None
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:  # Reaped by someone else.
+        proc.wait()
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def process_tree(pid: int) -> list[int]:
+    """pid and every process under it, from /proc."""
+    pids = [pid]
+    for parent in pids:  # Grows as children are found.
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children", "r") as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:  # Already gone.
+            pass
+    return pids
+
+
+def memory_kib(pid: int) -> tuple[int, int]:
+    """Resident and peak resident KiB of a process, 0 for both once it is gone."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    fields[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return fields.get("VmRSS", 0), fields.get("VmHWM", 0)
+
+
+class MemorySampler:
+    """
+    Peak resident KiB of a process and everything under it, sampled from /proc while it runs.
+    ru_maxrss from wait4 can't be used, Linux keeps the parent's high-water mark from before exec in it.
+    Processes that start and end between samples are missed, peak stays None if nothing was sampled
+    and on platforms without /proc.
+    """
+    def __init__(self, pid: int, interval: float = MEMORY_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if sys.platform.startswith("linux"):
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.stopped.wait(self.interval):
+                break
+
+    def sample(self):
+        resident = peak = 0
+        for pid in process_tree(self.pid):
+            rss, hwm = memory_kib(pid)
+            resident += rss
+            peak = max(peak, hwm)
+        if resident or peak:
+            self.peak = max(self.peak or 0, resident, peak)
+
+    def stop(self) -> Optional[int]:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return self.peak
+
+
+def stream_process(args, on_chunk: Optional[Callable[[str, str], None]] = None, control: RunControl = None,
+                   timeout: float = None,
+                   **popen_kwargs) -> tuple[int, OutputBuffer, OutputBuffer, attack.SectionStats]:
+    """
+    Run a process, reading stdout and stderr as they are written.
+    on_chunk is called with ("stdout" or "stderr", text) for every decoded chunk.
+    The process and its children are killed after timeout seconds, or when control is cancelled.
+    Returns the exit code, the buffers for stdout and stderr and the stats of the run,
+    the caller closes the buffers.
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **PROCESS_GROUP, **popen_kwargs)
+    if control is not None:
+        control.add_process(proc)
+    buffers = {"stdout": OutputBuffer(), "stderr": OutputBuffer()}
+    memory = MemorySampler(proc.pid)  # Popen returns once the child has exec'd, so only its own memory is seen.
+    memory.start()
+
+    def pump(pipe, name: str):
+        buffer = buffers[name]
+        with pipe:
+            for data in iter(lambda: pipe.read1(CHUNK_SIZE), b""):
+                text = buffer.write(data)
+                if text and on_chunk is not None:
+                    on_chunk(name, text)
+        text = buffer.finish()
+        if text and on_chunk is not None:
+            on_chunk(name, text)
+
+    # One reader per pipe, so a full stderr pipe can't block a child that is still writing stdout.
+    readers = [threading.Thread(target=pump, args=(proc.stdout, "stdout"), daemon=True),
+               threading.Thread(target=pump, args=(proc.stderr, "stderr"), daemon=True)]
+    usage = []
+    # Waited for in a thread, os.wait4 has no timeout but is the only way to the resource usage.
+    waiter = threading.Thread(target=lambda: usage.append(wait_usage(proc)), daemon=True)
+    for thread in readers + [waiter]:
+        thread.start()
+    try:
+        waiter.join(timeout)
+        if waiter.is_alive():
+            kill_tree(proc)
+            waiter.join()
+            for reader in readers:
+                reader.join()
+            buffers["stderr"].write_text(f"\nSection timed out after {timeout:g} seconds.\n")
+    finally:
+        if control is not None:
+            control.remove_process(proc)
+    for reader in readers:
+        reader.join()
+    stats = attack.SectionStats(time.monotonic() - start, usage[0], memory.stop(), proc.returncode,
+                                buffers["stdout"].size, buffers["stderr"].size)
+    return proc.returncode, buffers["stdout"], buffers["stderr"], stats
+
+
+def section_depends(sections: list[attack.SectionScript]) -> dict[int, list[int]]:
+    """Map each section id to the ids it waits for."""
+    if any(section.depends for section in sections):
+        return {section.section_id: list(section.depends) for section in sections}
+    # No dependencies given, every section waits for the one before it like it always has.
+    depends = {}
+    for i, section in enumerate(sections):
+        depends[section.section_id] = [sections[i - 1].section_id] if i > 0 else []
+    return depends
+
+
+class SectionScheduler:
+    """
+    Runs script sections on a bounded pool as soon as the sections they depend on have finished.
+    run_section is called with (section, variables) and returns the variables the section exported.
+    A section gets the attack variables updated with the exports of its dependencies, in the order listed.
+    proceed is checked before starting each section, returning False stops the run after the running sections.
+    """
+    def __init__(self, sections: list[attack.SectionScript], depends: dict[int, list[int]],
+                 run_section: Callable[[attack.SectionScript, dict], dict], variables: dict,
+                 max_workers: int = 1, proceed: Callable[[], bool] = lambda: True):
+        self.sections = {section.section_id: section for section in sections}
+        self.depends = depends
+        self.run_section = run_section
+        self.variables = variables
+        self.max_workers = max(1, max_workers)
+        self.proceed = proceed
+        self.check()
+
+    def check(self):
+        for section_id, deps in self.depends.items():
+            for dep in deps:
+                if dep not in self.sections:
+                    raise ValueError(f"Section {section_id} depends on section {dep}, which does not exist.")
+        # Kahn's algorithm, anything left over is part of a cycle.
+        remaining = {section_id: set(deps) for section_id, deps in self.depends.items()}
+        while remaining:
+            ready = [section_id for section_id, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Sections {sorted(remaining)} depend on each other.")
+            for section_id in ready:
+                remaining.pop(section_id)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(self) -> dict[int, dict]:
+        """Run every section, returns the variables each section exported by id."""
+        exported: dict[int, dict] = {}
+        waiting = {section_id: self.depends.get(section_id, []) for section_id in self.sections}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                while waiting or running:
+                    ready = [section_id for section_id, deps in waiting.items() if all(d in exported for d in deps)]
+                    for section_id in ready:
+                        if not self.proceed():  # Exit-point
+                            waiting.clear()
+                            break
+                        variables = dict(self.variables)
+                        for dep in waiting.pop(section_id):
+                            variables.update(exported[dep])
+                        running[pool.submit(self.run_section, self.sections[section_id], variables)] = section_id
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        exported[running.pop(future)] = future.result()
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+        return exported
+
+
+def run_sections(sections: list[attack.SectionScript], run_section: Callable[[attack.SectionScript, dict], dict],
+                 variables: dict, max_parallel: int = 4, proceed: Callable[[], bool] = lambda: True) -> dict[int, dict]:
+    """Run sections in order, or side by side when they list dependencies."""
+    parallel = any(section.depends for section in sections)
+    return SectionScheduler(sections,
+                            section_depends(sections),
+                            run_section,
+                            variables,
+                            max_parallel if parallel else 1,
+                            proceed).run()
+
+
+def init_target_worker(cancel):
+    global target_cancel
+    target_cancel = cancel
+
+
+def watch_cancel(cancelled: Callable[[], bool], on_cancel: Callable[[], None]) -> threading.Event:
+    """Call on_cancel once cancelled returns True, checking until the event returned is set."""
+    finished = threading.Event()
+
+    def watch():
+        while not finished.wait(CANCEL_POLL):
+            if cancelled():
+                on_cancel()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    return finished
+
+
+def run_target(sections: list[attack.SectionScript], variables: dict, engine, job: str,
+               max_parallel: int = 4, timeout: float = None) -> Optional[attack.Output]:
+    """
+    Run every section for one target with an engines.Engine, meant to be run in its own worker process.
+    timeout is the default most seconds per section. Ctrl-C, or cancelling the run_targets this runs for,
+    kills the running sections and skips the rest. Returns None when cancelled.
+    """
+    outputs: dict[int, attack.SectionOutput] = {}
+    control = RunControl(timeout)
+    if threading.current_thread() is threading.main_thread():
+        # Sections are in their own process groups, Ctrl-C only reaches this process.
+        signal.signal(signal.SIGINT, lambda signum, frame: control.cancel())
+
+    def run_section(section: attack.SectionScript, section_vars: dict) -> dict:
+        if section.section_type is attack.ScriptSectionType.EMPTY:
+            return section_vars
+        output, exported = engine.run(section, section_vars, job=job, control=control)
+        if not control.cancelled:  # Killed sections are left out, like in the ui.
+            outputs[section.section_id] = output
+        return exported
+
+    finished = threading.Event()
+    if target_cancel is not None:
+        if target_cancel.is_set():  # Cancelled before this target started.
+            return None
+        finished = watch_cancel(target_cancel.is_set, control.cancel)
+    try:
+        with engine:
+            run_sections(sections, run_section, variables, max_parallel if engine.parallel else 1,
+                         control.wait_resumed)
+    finally:
+        finished.set()
+    if control.cancelled:
+        return None
+    return attack.Output([outputs[section.section_id] for section in sections if section.section_id in outputs])
+
+
+def run_targets(sections: list[attack.SectionScript], variables: dict, targets: list[str], variable: str,
+                engine, max_workers: int = 4,
+                on_done: Optional[Callable[[str, Optional[BaseException]], None]] = None,
+                on_output: Optional[Callable[[str, attack.Output], None]] = None,
+                timeout: float = None, control: RunControl = None) -> dict[str, attack.Output]:
+    """
+    Run the script once per target with variable set to the target, up to max_workers targets at a time.
+    Each worker process gets its own copy of engine, an engines.Engine that hasn't been started,
+    sections run in the engine's cwd.
+    on_done is called with (target, None) when a target finishes or (target, exception) when it fails,
+    failed targets are left out of the result. on_output is called with (target, output) as each target finishes.
+    timeout is the default most seconds a section may run, see RunControl.
+    Cancelling control kills the running targets' sections and skips the targets not started,
+    cancelled targets are left out of the result and on_done isn't called for them.
+    Returns the output of each target, in the order of targets.
+    """
+    control = control if control is not None else RunControl()
+    cancel = multiprocessing.Event()  # Workers only see what they get when they start, so it is handed over then.
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_target_worker, initargs=(cancel,)) as pool:
+        futures = {}
+        for i, target in enumerate(targets):
+            future = pool.submit(run_target, sections, variables | {variable: target}, engine, f"t{i}_",
+                                 timeout=timeout)
+            futures[future] = target
+
+        def on_cancel():
+            cancel.set()
+            for pending in futures:
+                pending.cancel()
+
+        finished = watch_cancel(lambda: control.cancelled, on_cancel)
+        try:
+            for future in as_completed(futures):
+                target = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    output = future.result()
+                except Exception as e:
+                    if on_done is None:
+                        raise
+                    on_done(target, e)
+                    continue
+                if output is None:  # Cancelled while it ran.
+                    continue
+                results[target] = output
+                if on_output is not None:
+                    on_output(target, output)
+                if on_done is not None:
+                    on_done(target, None)
+        finally:
+            finished.set()
+    return {target: results[target] for target in targets if target in results}
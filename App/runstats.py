@@ -0,0 +1,96 @@
+"""
+Summaries of how an attack's sections ran, from the SectionStats each output keeps.
+format_summary is the table shown after a run, slowest sections first.
+export writes the same as JSON, for comparing runs across engagements:
+  {"attack": str, "version": str,
+   "sections": [{"target": str or null, "id": int, "name": str, wall_time, cpu_time, ...}],
+   "total": {"sections": int, "failed": int, "wall_time", "cpu_time", "max_rss", "stdout_bytes", "stderr_bytes"}}
+Sections run side by side, so their summed wall time can be more than the run took.
+"""
+import json
+from typing import Optional
+
+import attack
+
+
+def section_rows(atk: attack.Attack) -> list[dict]:
+    """One row per section output that has stats, targets after the attack's own output."""
+    names = {section.section_id: section.name for section in atk.script.sections}
+    outputs = [(None, atk.output)] if atk.output is not None else []
+    outputs += list(atk.targets.items())
+    rows = []
+    for target, output in outputs:
+        for section in output.sections:
+            if section.stats is None:
+                continue
+            rows.append({"target": target, "id": section.section_id, "name": names.get(section.section_id, "")}
+                        | section.stats.to_dict())
+    return rows
+
+
+def total(rows: list[dict], field: str, combine=sum) -> Optional[float]:
+    """field combined over rows, None when no row has it."""
+    values = [row[field] for row in rows if row[field] is not None]
+    return combine(values) if values else None
+
+
+def summary(atk: attack.Attack) -> dict:
+    rows = section_rows(atk)
+    return {"attack": atk.meta.name,
+            "version": atk.meta.version,
+            "sections": rows,
+            "total": {"sections": len(rows),
+                      "failed": sum(1 for row in rows if row["exit_code"] not in (0, None)),
+                      "wall_time": total(rows, "wall_time"),
+                      "cpu_time": total(rows, "cpu_time"),
+                      "max_rss": total(rows, "max_rss", max),
+                      "stdout_bytes": total(rows, "stdout_bytes"),
+                      "stderr_bytes": total(rows, "stderr_bytes")}}
+
+
+def export(atk: attack.Attack, path: str):
+    with attack.atomic_file(path) as f:
+        f.write(json.dumps(summary(atk), indent=2).encode("UTF-8"))
+
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def format_seconds(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds:.2f}s"
+
+
+def format_summary(atk: attack.Attack, limit: int = None) -> str:
+    """Text table of the sections, slowest first, limit rows at most."""
+    result = summary(atk)
+    rows = sorted(result["sections"], key=lambda row: row["wall_time"], reverse=True)
+    if not rows:
+        return "No section stats, run the attack first."
+    with_target = any(row["target"] is not None for row in rows)
+    header = ["Section", "Wall", "CPU", "Peak RSS", "Exit", "Output"]
+    if with_target:
+        header.insert(0, "Target")
+    lines = [header]
+    for row in rows[:limit]:
+        line = [row["name"] or str(row["id"]), format_seconds(row["wall_time"]), format_seconds(row["cpu_time"]),
+                format_size(row["max_rss"] * 1024 if row["max_rss"] is not None else None),
+                "-" if row["exit_code"] is None else str(row["exit_code"]),
+                format_size(row["stdout_bytes"] + row["stderr_bytes"])]
+        if with_target:
+            line.insert(0, row["target"] or "")
+        lines.append(line)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    text = "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in lines)
+    totals = result["total"]
+    text += (f"\n{totals['sections']} section(s), {totals['failed']} failed, "
+             f"{format_seconds(totals['wall_time'])} wall, {format_seconds(totals['cpu_time'])} cpu")
+    if limit is not None and len(rows) > limit:
+        text += f", {len(rows) - limit} more not shown"
+    return text
@@ -0,0 +1,253 @@
+"""
+One long-lived shell per attack, instead of a new shell and batch file per section.
+Sections are written to the shell's stdin, bash on Linux and cmd on Windows.
+After each section the shell prints a marker on stdout and stderr, everything before the marker
+is that section's output and the text after the stdout marker is its exit code.
+Variables stay set in the shell between sections, the ones a section changed are read back
+through the same markers so nothing goes through nv/iv/cv files or diff.exe.
+"""
+import codecs
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+import attack
+import runner
+
+
+class SessionStream:
+    """Reads one pipe of the shell, splitting it into sections at the marker."""
+    def __init__(self, name: str, pipe, marker: str):
+        self.name = name
+        self.pipe = pipe
+        self.marker = marker
+        self.decoder = codecs.getincrementaldecoder("UTF-8")(errors="replace")
+        self.lock = threading.Lock()
+        self.pending = ""  # Text that could still be the start of a marker, or that no section has claimed yet.
+        self.buffer: Optional[runner.OutputBuffer] = None
+        self.on_chunk: Optional[Callable[[str, str], None]] = None
+        self.done = threading.Event()
+        self.tail = ""  # Rest of the marker line.
+        self.eof = False
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+        self.thread.start()
+
+    def start(self, buffer: runner.OutputBuffer, on_chunk: Optional[Callable[[str, str], None]] = None):
+        with self.lock:
+            self.buffer = buffer
+            self.on_chunk = on_chunk
+            self.tail = ""
+            self.done.clear()
+            if self.eof:
+                self.finish()
+            else:
+                self.feed("")
+
+    def pump(self):
+        with self.pipe:
+            for data in iter(lambda: self.pipe.read1(runner.CHUNK_SIZE), b""):
+                with self.lock:
+                    self.feed(self.decoder.decode(data))
+        with self.lock:
+            self.feed(self.decoder.decode(b"", final=True))
+            self.eof = True
+            self.finish()
+
+    def finish(self):
+        if self.buffer is not None:  # The shell exited in the middle of a section.
+            self.write(self.pending)
+            self.pending = ""
+            self.buffer = None
+        self.done.set()
+
+    def feed(self, text: str):
+        self.pending += text
+        if self.buffer is None:
+            return
+        idx = self.pending.find(self.marker)
+        if idx >= 0:
+            end = self.pending.find("\n", idx + len(self.marker))
+            if end < 0:
+                return  # Wait for the rest of the marker line.
+            self.write(self.pending[:idx])
+            self.tail = self.pending[idx + len(self.marker):end].strip()
+            self.pending = self.pending[end + 1:]
+            self.buffer = None
+            self.done.set()
+            return
+        safe = len(self.pending) - len(self.marker) + 1  # Hold back anything that could be a partial marker.
+        if safe > 0:
+            self.write(self.pending[:safe])
+            self.pending = self.pending[safe:]
+
+    def write(self, text: str):
+        if not text:
+            return
+        self.buffer.write_text(text)
+        if self.on_chunk is not None:
+            self.on_chunk(self.name, text)
+
+
+class ShellSession:
+    """
+    A shell kept running for every section of an attack.
+    Sections run one at a time, variables set by one section are seen by the next.
+    """
+    def __init__(self, cwd: str = None):
+        self.cwd = cwd
+        self.windows = os.name == "nt"
+        self.newline = "\r\n" if self.windows else "\n"
+        self.token = f"__APT_{uuid.uuid4().hex}__"
+        self.proc: Optional[subprocess.Popen] = None
+        self.stdout: Optional[SessionStream] = None
+        self.stderr: Optional[SessionStream] = None
+        self.baseline: dict = {}  # Variables the shell started with, these are never exported.
+        self.env: dict = {}  # Variables last seen in the shell.
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        args = ["cmd.exe", "/D", "/Q"] if self.windows else ["bash", "--noprofile", "--norc"]
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     cwd=self.cwd, **runner.PROCESS_GROUP)
+        marker = self.newline + self.token
+        self.stdout = SessionStream("stdout", self.proc.stdout, marker)
+        self.stderr = SessionStream("stderr", self.proc.stderr, marker)
+        self.execute("")  # Swallows cmd's banner.
+        self.baseline = self.read_env()
+        self.env = dict(self.baseline)
+
+    def close(self):
+        if self.alive:
+            try:
+                self.proc.stdin.write(f"exit{self.newline}".encode())
+                self.proc.stdin.close()
+                self.proc.wait(5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+        self.proc = None
+
+    def trailer(self) -> str:
+        if self.windows:
+            return (f"echo.{self.newline}echo {self.token} %ERRORLEVEL%{self.newline}"
+                    f"echo. 1>&2{self.newline}echo {self.token} 1>&2{self.newline}")
+        return f"printf '\\n%s %s\\n' {self.token} \"$?\"\nprintf '\\n%s\\n' {self.token} >&2\n"
+
+    def execute(self, command: str, stdout: runner.OutputBuffer = None, stderr: runner.OutputBuffer = None,
+                on_chunk: Optional[Callable[[str, str], None]] = None, timeout: float = None) -> int:
+        """
+        Run command in the shell, waiting for both markers. Returns the exit code.
+        After timeout seconds the shell and everything it started is killed, the next section starts a new one.
+        """
+        stdout = stdout if stdout is not None else runner.OutputBuffer()
+        stderr = stderr if stderr is not None else runner.OutputBuffer()
+        with self.lock:
+            self.stdout.start(stdout, on_chunk)
+            self.stderr.start(stderr, on_chunk)
+            try:
+                self.proc.stdin.write((command + self.trailer()).encode())
+                self.proc.stdin.flush()
+            except OSError:  # The shell is gone, the readers see EOF.
+                pass
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            for stream in (self.stdout, self.stderr):
+                if not stream.done.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                    runner.kill_tree(self.proc)
+                    self.stdout.done.wait()
+                    self.stderr.done.wait()
+                    stderr.write_text(f"\nSection timed out after {timeout:g} seconds.\n")
+                    break
+        if self.stdout.tail.lstrip("-").isdigit():
+            return int(self.stdout.tail)
+        return self.proc.wait()
+
+    def read_env(self) -> dict:
+        out = runner.OutputBuffer()
+        self.execute("set" + self.newline if self.windows else "env -0\n", out)
+        text = out.getvalue()
+        out.close()
+        env = {}
+        for entry in text.split("\r\n" if self.windows else "\0"):
+            name, sep, value = entry.partition("=")
+            if sep and name:
+                env[name] = value
+        env.pop("_", None)  # bash's last argument.
+        return env
+
+    def set_variables(self, variables: dict):
+        lines = []
+        for name, value in variables.items():
+            if self.env.get(name) == value:
+                continue
+            if self.windows:
+                lines.append(f"set \"{name}={value}\"")
+            else:
+                quoted = str(value).replace("'", "'\\''")
+                lines.append(f"export {name}='{quoted}'")
+        if lines:
+            self.execute(self.newline.join(lines) + self.newline)
+            self.env.update(variables)
+
+    def exported(self) -> dict:
+        """Variables the sections set or changed since the shell started."""
+        self.env = self.read_env()
+        return {name: value for name, value in self.env.items() if self.baseline.get(name) != value}
+
+    def run(self, section: attack.SectionScript, variables: dict,
+            on_chunk: Optional[Callable[[str, str], None]] = None, control: runner.RunControl = None,
+            timeout: float = None) -> tuple[attack.SectionOutput, dict]:
+        """
+        Run one section with variables set, same results as the other engines in engines.py.
+        Cancelling control kills the shell along with the section, as does running past timeout seconds.
+        """
+        if not self.alive:  # A section ended the shell, start over with the variables it was given.
+            self.start()
+        self.set_variables(variables)
+        scr_path = None
+        if self.windows:
+            # cmd can only run batch syntax (labels, %%a) from a file.
+            if section.section_type is attack.ScriptSectionType.REFERENCE:
+                target = section.content
+            else:
+                with tempfile.NamedTemporaryFile("w", suffix=".bat", delete=False) as f:
+                    f.write(section.content)
+                    scr_path = target = f.name
+            command = f"call \"{target}\" < nul{self.newline}"
+        elif section.section_type is attack.ScriptSectionType.REFERENCE:
+            command = f". \"{section.content}\" < /dev/null\n"
+        else:
+            command = f"{{\n{section.content}\n}} < /dev/null\n"  # Braces run it in this shell, keeping its variables.
+        stdout, stderr = runner.OutputBuffer(), runner.OutputBuffer()
+        if control is not None:
+            control.add_process(self.proc)
+        start = time.monotonic()
+        try:
+            exit_code = self.execute(command, stdout, stderr, on_chunk, timeout)
+            # The shell outlives the section, so its cpu time and memory aren't the section's and aren't kept.
+            stats = attack.SectionStats(time.monotonic() - start, exit_code=exit_code, stdout_bytes=stdout.size,
+                                        stderr_bytes=stderr.size)
+            output = attack.SectionOutput(section.section_id, stdout.detach(), stderr.detach(), stats)
+        finally:
+            if control is not None:
+                control.remove_process(self.proc)
+            stdout.close()
+            stderr.close()
+            if scr_path is not None:
+                os.remove(scr_path)
+        if not self.alive:
+            return output, dict(variables)
+        return output, self.exported()
@@ -0,0 +1,77 @@
+"""
+Keeping big section output on disk instead of in memory.
+Output under runner.SPOOL_SIZE stays a string. Bigger output stays in the temp file it was captured to,
+as a SpillBlob, and is read back each time it is used rather than kept.
+SectionOutput.open_stdout and open_stderr give readers over either, for going through output in pieces.
+"""
+import collections
+import os
+import weakref
+from typing import TextIO, Union
+
+import attack
+
+LINE_GUESS = 128  # Bytes per line guessed when reading the end of a file.
+
+
+class SpillBlob(attack.Blob):
+    """Output in a temp file, removed once nothing refers to it."""
+    keep = False
+
+    def __init__(self, path: str, encoding: str = "UTF-8"):
+        self.path = path
+        self.encoding = encoding
+        self.remover = weakref.finalize(self, remove, path)
+
+    def pin(self):
+        """Keep the temp file once this is gone, until unpin. Used by journal.Journal to refer to it."""
+        self.remover.detach()
+
+    def unpin(self):
+        if not self.remover.alive:
+            self.remover = weakref.finalize(self, remove, self.path)
+
+    def __reduce__(self):
+        # Copies in other processes get the text, the temp file goes when this one does.
+        return str, (self.read(),)
+
+    def open(self) -> TextIO:
+        return open(self.path, "r", encoding=self.encoding, errors="replace", newline="")
+
+    def read(self) -> str:
+        with self.open() as f:
+            return f.read()
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def tail(self, max_lines: int) -> str:
+        """The last max_lines lines, read from the end of the file instead of through all of it."""
+        size = os.path.getsize(self.path)
+        window = max_lines * LINE_GUESS
+        with open(self.path, "rb") as f:
+            while True:
+                start = max(0, size - window)
+                f.seek(start)
+                lines = f.read(size - start).decode(self.encoding, errors="replace").splitlines(keepends=True)
+                if start == 0:
+                    return "".join(lines[-max_lines:])
+                if len(lines) > max_lines:  # The first one may be cut off, it is dropped.
+                    return "".join(lines[-max_lines:])
+                window *= 4  # Longer lines than guessed.
+
+
+def tail(value: Union[str, attack.Blob], max_lines: int) -> str:
+    """The last max_lines lines of a stdout or stderr as SectionOutput.streams gives it."""
+    if isinstance(value, SpillBlob):
+        return value.tail(max_lines)
+    with attack.SectionOutput.open_text(value) as f:
+        return "".join(collections.deque(f, maxlen=max_lines))
+
+
+def remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
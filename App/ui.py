@@ -1,37 +1,31 @@
 import re
 import sys
 import os
+import threading
 
-import fitz
-import pylatex
 import webbrowser
-from typing import Optional, Union
+from typing import Optional
 
 from PyQt6 import uic
-from PyQt6.QtCore import QCoreApplication, QRunnable, QThreadPool, pyqtSlot, QSize, QObject, pyqtSignal, QByteArray
-from PyQt6.QtGui import QKeySequence, QMovie, QPixmap
+from PyQt6.QtCore import QCoreApplication, QRunnable, QThreadPool, QTimer, pyqtSlot, QSize, QObject, pyqtSignal
+from PyQt6.QtGui import QImage, QKeySequence, QMovie, QPixmap, QTextCursor
 from PyQt6.QtWidgets import QDialog, QFileDialog, QErrorMessage, QApplication, QMainWindow, QTableWidgetItem
-from pylatex import NoEscape
 
 import attack
-import subprocess
-
-
-class EndDocumentException(Exception):
-    def __init__(self, message="Document generation is ending early. Likely due to a pattern with END behavior."):
-        self.message = message
-
-
-class PatternErrorException(Exception):
-    def __init__(self,
-                 message="Document generation failed because an ERROR pattern matched, check your attack output."):
-        self.message = message
-
-
-class LatexException(Exception):
-    def __init__(self, message="Document generation failed, the LaTeX was invalid.", invalid_latex: str = ""):
-        self.message = message
-        self.invalid_latex = invalid_latex
+import engines
+import journal
+import latex
+import preview
+import profiler
+import report
+import runner
+import runstats
+import store
+
+RUN_LOG_LINES = 10000  # Lines of run output kept on screen, older lines are dropped.
+RUN_LOG_FPS = 30  # Most times a second new run output is drawn, output arriving in between is drawn together.
+RUN_SUMMARY_ROWS = 20  # Slowest sections listed in the run log once a run is done.
+PREVIEW_DELAY = 500  # Milliseconds without typing before the live preview is built again.
 
 
 class CreateAttackDlg(QDialog):
@@ -47,6 +41,7 @@ class CreateAttackDlg(QDialog):
         out = attack.Output([])
         main_window.atk = attack.Attack(meta, scr, doc, {}, out)
         main_window.atk_path = ""
+        main_window.set_journal(None)
         main_window.setWindowTitle(f"APT - *{main_window.atk.meta.name}")
         self.parent().script_clear()
         self.parent().var_load()
@@ -60,18 +55,24 @@ class AttackUnsavedDlg(QDialog):
         super().__init__(parent)
         uic.loadUi("UI/unsaved_dialog.ui", self)
         self.buttonBox.buttons()[0].clicked.connect(self.save)
-        self.buttonBox.buttons()[2].clicked.connect(QCoreApplication.quit)
+        self.buttonBox.buttons()[2].clicked.connect(self.discard)
         self.buttonBox.buttons()[1].clicked.connect(self.reject)
 
     def save(self):
         self.parent().save_attack_as()
 
+    def discard(self):
+        if self.parent().journal is not None:
+            self.parent().journal.clear()  # Or the changes come back the next time it's opened.
+        QCoreApplication.quit()
+
 
 class ScriptWorkerSignals(QObject):
     # Signals
     change_statusline: pyqtSignal = pyqtSignal(str)
     append_scriptout: pyqtSignal = pyqtSignal(str)
-    append_output: pyqtSignal = pyqtSignal(attack.SectionOutput)
+    append_chunk: pyqtSignal = pyqtSignal(str)
+    append_output: pyqtSignal = pyqtSignal(attack.SectionOutput, object)  # And its journal record, or None.
     append_scriptout_from_section: pyqtSignal = pyqtSignal()
     finished: pyqtSignal = pyqtSignal()
 
@@ -85,6 +86,10 @@ class ScriptWorker(QRunnable):
                  prefix: str,
                  postfix: str,
                  variables: dict,
+                 stream: bool = True,
+                 max_parallel: int = 4,
+                 engine: str = "",
+                 log: journal.Journal = None,
                  *args, **kwargs):
         super(ScriptWorker, self).__init__()
         # Store constructor arguments (re-used for processing)
@@ -97,229 +102,169 @@ class ScriptWorker(QRunnable):
         self.postfix = postfix
         self.sections = sections
         self.vars = variables
+        self.stream = stream  # Emit output chunks as they arrive instead of once per section.
+        self.max_parallel = max_parallel  # Most sections running at once when sections list dependencies.
+        self.parallel = False
+        self.engine_name = engine  # One of engines.ENGINES, "" for the usual engine of this platform.
+        self.log = log  # Outputs are journaled from here as sections finish, not on the gui thread.
+        self.engine: Optional[engines.Engine] = None
+        self.emit_lock = threading.Lock()  # Keeps each section's signals together when sections run side by side.
         self.signals = ScriptWorkerSignals()
-        self.paused = False
-        self.killed = False
-
-    @staticmethod
-    def clean_stderr(stderr: str) -> str:
-        err_lines = stderr.split("\r\n")
-        for i in reversed(range(len(err_lines))):
-            if re.match("^Could Not Find.*nv$", err_lines[i]):
-                err_lines.pop(i)
-            elif "The system cannot find the file nv." == err_lines[i]:
-                err_lines.pop(i)
-        return "\r\n".join(err_lines)
+        self.control = runner.RunControl()  # Pause, unpause and kill come from the UI thread.
 
     @pyqtSlot()
     def run(self):
         try:
-            for section in self.sections:
-                self.signals.change_statusline.emit(f"Running section: {section.name}")
-                atk_dir = os.path.dirname(os.path.abspath(self.atk_path))
-                os.chdir(atk_dir)  # Operating from atk dir.
-                vars_str = self.from_vars()
-                scr_path = ""
-                if section.section_type is attack.ScriptSectionType.EMPTY:
-                    continue
-                elif section.section_type is attack.ScriptSectionType.EMBEDDED:
-                    scr_path = f"{self.atk_name}_{section.section_id}.bat"
-                    with open(scr_path, "w") as f:
-                        if section.section_id == 0:
-                            f.write(self.prefix +
-                                    vars_str +
-                                    section.content +
-                                    self.postfix.replace("diff.exe", f"{self.app_dir}\\diff.exe")
-                                    )
-                        else:
-                            f.write(self.prefix +
-                                    section.content +
-                                    self.postfix.replace("diff.exe", f"{self.app_dir}\\diff.exe")
-                                    )
-                elif section.section_type is attack.ScriptSectionType.REFERENCE:
-                    org_scr_path = f"{section.content}"
-                    scr_path = f"{self.atk_name}_{section.section_id}.bat"
-                    with open(org_scr_path, "r") as o:
-                        with open(scr_path, "w") as f:
-                            if section.section_id == 0:
-                                f.write(self.prefix +
-                                        vars_str +
-                                        o.read() +
-                                        self.postfix.replace("diff.exe", f"{self.app_dir}\\diff.exe")
-                                        )
-                            else:
-                                f.write(self.prefix +
-                                        o.read() +
-                                        self.postfix.replace("diff.exe", f"{self.app_dir}\\diff.exe")
-                                        )
-                if self.killed:  # Exit-point
-                    return
-                shell_out = subprocess.run([scr_path], shell=False, capture_output=True)
-                if self.killed:  # Exit-point
-                    return
-                self.signals.append_scriptout.emit(f"{'=' * 10}\nSection: {section.name}\n{'=' * 10}")
-                self.signals.append_output.emit(attack.SectionOutput(
-                    section.section_id,
-                    shell_out.stdout.decode("UTF-8"),
-                    self.clean_stderr(shell_out.stderr.decode("UTF-8"))
-                ))
-                self.signals.append_scriptout_from_section.emit()
-                if section.section_type is attack.ScriptSectionType.EMBEDDED:
-                    os.remove(scr_path)
-                while self.paused:
-                    pass  # Sit and wait.
-            os.remove("nv")
+            atk_dir = os.path.dirname(os.path.abspath(self.atk_path))  # Sections run in it, see engines.Engine.
+            self.engine = engines.create_engine(self.engine_name, self.app_dir, self.atk_name, self.prefix,
+                                                self.postfix, atk_dir)
+            with self.engine:
+                self.parallel = self.engine.parallel and any(section.depends for section in self.sections)
+                runner.run_sections(self.sections,
+                                    self.run_section,
+                                    self.vars,
+                                    self.max_parallel if self.engine.parallel else 1,
+                                    self.proceed)
+        except ValueError as e:  # Bad dependencies.
+            self.signals.change_statusline.emit(str(e))
         except AttributeError:
             return
         except FileNotFoundError:
             pass
         finally:
-            os.chdir(self.app_dir)
             self.signals.finished.emit()
 
+    def run_section(self, section: attack.SectionScript, variables: dict) -> dict:
+        if section.section_type is attack.ScriptSectionType.EMPTY:
+            return variables
+        self.signals.change_statusline.emit(f"Running section: {section.name}")
+        # Chunks from sections running side by side would interleave, so those are shown once finished.
+        live = self.stream and not self.parallel
+        header = f"{'=' * 10}\nSection: {section.name}\n{'=' * 10}"
+        if live:
+            self.signals.append_scriptout.emit(header + "\n")
+        output, exported = self.engine.run(section, variables, on_chunk=self.emit_chunk if live else None,
+                                           control=self.control)
+        if self.control.cancelled:  # Exit-point
+            return exported
+        with self.emit_lock:
+            record = self.log.record_output(output, pending=True) if self.log is not None else None
+            if not live:
+                self.signals.append_scriptout.emit(header)
+            self.signals.append_output.emit(output, record)
+            if not live:
+                self.signals.append_scriptout_from_section.emit()
+        return exported
+
+    def proceed(self) -> bool:
+        return self.control.wait_resumed()  # Sleeps while paused.
+
+    def emit_chunk(self, stream_name: str, text: str):
+        self.signals.append_chunk.emit(text)
+
     @pyqtSlot()
     def pause(self):
-        self.paused = True
+        self.control.pause()
 
     @pyqtSlot()
     def unpause(self):
-        self.paused = False
+        self.control.resume()
 
     @pyqtSlot()
     def kill(self):
-        self.killed = True
+        self.control.cancel()  # Also kills the sections that are running.
 
-    def from_vars(self):
-        content = ""
-        for i in self.vars.keys():
-            if " " in self.vars[i]:
-                content += f"set {i}=\"{self.vars[i]}\"\n"
-            else:
-                content += f"set {i}={self.vars[i]}\n"
-        return content
+
+class FormatWorker(QRunnable):
+    """Precompiles the report preamble, so the first preview doesn't wait for it."""
+    def __init__(self, formats: latex.FormatCache):
+        super(FormatWorker, self).__init__()
+        self.formats = formats
+
+    def run(self):
+        self.formats.format_for(latex.split_preamble(report.Report.create_document())[0])
 
 
 class DocumentWorkerSignals(QObject):
     change_statusline: pyqtSignal = pyqtSignal(str)
-    new_preview: pyqtSignal = pyqtSignal(list)
+    # Both start with the preview's generation, see MainWindow.preview_generation.
+    new_preview: pyqtSignal = pyqtSignal(int, int)  # Page count, pages follow through preview_page.
+    preview_page: pyqtSignal = pyqtSignal(int, int, QImage)
+    profiled: pyqtSignal = pyqtSignal(object)  # The worker's profiler.Profiler, once it is done.
     finished: pyqtSignal = pyqtSignal(int)
 
 
 class DocumentWorker(QRunnable):
-    def __init__(self, section: int, filename: str, atk_path: str, atk: attack.Attack, app_dir: str):
+    def __init__(self, section: int, filename: str, atk_path: str, atk: attack.Attack, app_dir: str,
+                 per_target: bool = False, cache: report.ReportCache = None, pages: preview.PageCache = None,
+                 zoom: float = 1.0, formats: latex.FormatCache = None, generation: int = 0, first: int = 0):
         self.signals = DocumentWorkerSignals()
         self.section = section  # -1 for full document, positive int for specific section.
         self.filename = filename
         self.atk_path = atk_path
         self.atk = atk
         self.app_dir = app_dir
+        self.per_target = per_target  # Full document with every section repeated for each target.
+        self.profile = profiler.Profiler()
+        atk_dir = os.path.dirname(os.path.abspath(atk_path))
+        self.report = report.Report(atk, cache, self.profile, formats, atk_dir)
+        self.path = os.path.join(atk_dir, filename)  # Where the pdf goes, without .pdf.
+        self.pages = pages
+        self.zoom = zoom
+        self.first = first  # The page being looked at, rasterized before the others.
+        self.cancelled = False  # A newer preview was asked for, stop rendering this one.
+        self.generation = generation
+        self.page_count: Optional[int] = None
         super(DocumentWorker, self).__init__()
 
-    def get_matching_patterns(self, doc_section_id: int) -> list[attack.Pattern]:
-        output_section = None
-        doc_section = None
-        matching = []
-        for o_s in self.atk.output.sections:
-            if o_s.section_id == doc_section_id:
-                output_section = o_s
-                break
-        for d_s in self.atk.document.sections:
-            if d_s.section_id == doc_section_id:
-                doc_section = d_s
-                break
-        for pattern in doc_section.patterns:
-            if re.search(pattern.pattern_str, output_section.stdout):
-                matching.append(pattern)
-        return matching
-
-    def create_section(self, doc: pylatex.Document, document_section_id: int):
-        section = None
-        remove_section = False
-        for d_s in self.atk.document.sections:
-            if d_s.section_id == document_section_id:
-                section = d_s
-                break
-
-        with doc.create(pylatex.Section(section.name)):
-            if section.section_type is attack.DocumentSectionType.REFERENCE:
-                with open(section.content, "r") as f:
-                    doc.append(NoEscape(f.read()))
-            elif section.section_type is attack.DocumentSectionType.LITERAL:
-                doc.append(NoEscape(section.content))
-            elif section.section_type is attack.DocumentSectionType.PATTERN:
-                matching = self.get_matching_patterns(document_section_id)
-                to_add = NoEscape(section.content)  # I want a copy of the content string.
-                for match in matching:
-                    if match.behavior is attack.PatternBehavior.ADD:
-                        to_add = NoEscape(str(to_add) + match.match_content)
-                    elif match.behavior is attack.PatternBehavior.REPLACE:
-                        to_add = NoEscape(match.match_content)
-                    elif match.behavior is attack.PatternBehavior.REMOVE:
-                        remove_section = True
-                    elif match.behavior is attack.PatternBehavior.END:
-                        raise EndDocumentException()
-                    elif match.behavior is attack.PatternBehavior.ERROR:
-                        raise PatternErrorException()
-                doc.append(to_add)
-            elif section.section_type is attack.DocumentSectionType.COMBINED:
-                pass  # This one is complicated, might work on it later.
-        if remove_section:
-            doc.pop(-1)
-
-    @staticmethod
-    def create_document() -> pylatex.Document:
-        document = pylatex.Document()
-        pkgs = [pylatex.Package("listings")]
-        [document.packages.append(x) for x in pkgs]
-        return document
-
-    def create_section_preview(self, path: str):
-        document = self.create_document()
-        self.create_section(document, self.section)
-        try:
-            document.generate_pdf(path, clean_tex=True)
-        except subprocess.CalledProcessError as e:
-            print(e.stdout, str(e.stderr))
-            raise LatexException()
-
-    def create_report(self, path: str):
-        document = self.create_document()
-        for section in self.atk.document.sections:
-            self.create_section(document, section.section_id)
-        try:
-            document.generate_pdf(path, clean_tex=True)
-        except subprocess.CalledProcessError as e:
-            print(e.stdout, e.stderr)
-            raise LatexException()
-
     # noinspection PyUnresolvedReferences
     def run(self):
+        if self.cancelled:  # Replaced before it got a thread.
+            self.signals.finished.emit(self.section)
+            return
         self.signals.change_statusline.emit("Starting.")
-        atk_dir = os.path.dirname(os.path.abspath(self.atk_path))
-        os.chdir(atk_dir)
         try:
             if self.section >= 0:
                 self.signals.change_statusline.emit(
-                    f"Generating preview for section: {self.atk.document.sections[self.section].name}."
+                    f"Generating preview for section: {self.atk.document.get_section(self.section).name}."
                 )
-                self.create_section_preview(self.filename)
-                page_pix: list[QPixmap] = []
-                for page in fitz.open(self.filename+".pdf"):
-                    page_pix.append(QPixmap())
-                    page_pix[-1].loadFromData(QByteArray(page.get_pixmap().pil_tobytes(format="JPEG")), format="JPEG")
-                self.signals.new_preview.emit(page_pix)
+                self.report.create_section_preview(self.path, self.section)
+                with self.profile.span("rasterize"):
+                    preview.rasterize(self.path + ".pdf", self.emit_page, self.zoom, self.first, self.pages,
+                                      proceed=lambda: not self.cancelled)
+                self.signals.change_statusline.emit(f"Done. {self.profile.summary()}")
             else:
-                self.signals.change_statusline.emit("Generating report.")
-                self.create_report(self.filename)
-            self.signals.change_statusline.emit("Done.")
-        except LatexException as e:
+                if self.per_target:
+                    self.signals.change_statusline.emit("Generating report for every target.")
+                    built = self.report.create_targets_report(self.path)
+                else:
+                    self.signals.change_statusline.emit("Generating report.")
+                    built = self.report.create_report(self.path)
+                self.signals.change_statusline.emit(f"Done. {self.profile.summary()}" if built else
+                                                    "Done, nothing changed since the last report.")
+        except report.LatexException as e:
             self.signals.change_statusline.emit(e.message)
-        except PatternErrorException as e:
+        except report.PatternErrorException as e:
             self.signals.change_statusline.emit(e.message)
-        except EndDocumentException as e:
+        except report.EndDocumentException as e:
             self.signals.change_statusline.emit(e.message)
-        os.chdir(self.app_dir)
-        self.signals.finished.emit(self.section)
+        except Exception as e:  # Like a reference to a file that isn't there yet, while typing its name.
+            self.signals.change_statusline.emit(f"Document generation failed: {e}")
+        finally:
+            self.signals.profiled.emit(self.profile)
+            self.signals.finished.emit(self.section)
+
+    def emit_page(self, number: int, count: int, page: preview.RasterPage):
+        if self.page_count is None:
+            self.page_count = count
+            self.signals.new_preview.emit(self.generation, count)
+        # QImage is fine off the gui thread, it becomes a QPixmap once it gets there.
+        image = QImage(page.samples, page.width, page.height, page.stride, QImage.Format.Format_RGB888).copy()
+        self.signals.preview_page.emit(self.generation, number, image)
+
+    @pyqtSlot()
+    def cancel(self):
+        self.cancelled = True
 
 
 # noinspection PyUnresolvedReferences
@@ -334,8 +279,19 @@ class MainWindow(QMainWindow):
         self.loading: bool = False
         # Thread Pool
         self.pool = QThreadPool()
-        self.workers: list[Union[ScriptWorker, DocumentWorker]] = []
+        self.workers: list[ScriptWorker] = []  # Running attacks, what run_pause and run_stop act on.
+        self.report_cache = report.ReportCache()  # Rendered sections, shared by every DocumentWorker.
+        self.page_cache = preview.PageCache()  # Rasterized preview pages.
+        # Precompiled preamble for this session, removed on quit. A new one is made if the packages change.
+        self.latex_formats = latex.FormatCache()
+        self.pool.start(FormatWorker(self.latex_formats))
+        self.preview_worker: Optional[DocumentWorker] = None  # The preview being built, one at a time.
+        self.report_worker: Optional[DocumentWorker] = None  # The full report being built.
+        self.preview_generation = 0  # Counts previews started, pages of any but the latest are dropped.
+        self.preview_pending = False  # Asked for while one was building, it starts when that one is done.
+        self.report_profile: Optional[profiler.Profiler] = None  # Timings of the last report or preview.
         self.run_paused = False
+        self.run_log_pending: list[str] = []  # Run output not drawn yet, see run_log_flush.
         print(f"Using up to {self.pool.maxThreadCount()} thread(s)")
         # Dialogs
         self.create_dlg = None
@@ -346,6 +302,20 @@ class MainWindow(QMainWindow):
         self.atk: Optional[attack.Attack] = None
         self.atk_saved = False
         self.prog_version = "0.0.0"
+        # Journal of changes since the last save, see journal.py.
+        self.journal: Optional[journal.Journal] = None
+        self.journal_timer = QTimer(self)  # Edits are journaled once typing stops for a moment.
+        self.journal_timer.setSingleShot(True)
+        self.journal_timer.setInterval(2000)
+        self.journal_timer.timeout.connect(self.journal_head)
+        self.autosave_timer = QTimer(self)  # Compacts the journal into the attack file.
+        self.autosave_timer.setInterval(5 * 60 * 1000)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start()
+        self.preview_timer = QTimer(self)  # Live preview, built once typing stops for a moment.
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.gen_live_refresh)
         # Paths
         self.atk_path = ""
         self.app_dir = ""
@@ -369,6 +339,8 @@ class MainWindow(QMainWindow):
         self.actionManual.setShortcut(QKeySequence("F1"))
         self.actionGenerate_Doc.triggered.connect(self.gen_generate)
         self.actionGenerate_Doc.setShortcut(QKeySequence("F6"))
+        self.actionExport_Run_Stats.triggered.connect(self.export_run_stats)
+        self.actionExport_Report_Profile.triggered.connect(self.export_report_profile)
         # Buttons
         self.script_section_add.clicked.connect(self.script_section_add_new)
         self.script_section_remove.clicked.connect(self.script_section_remove_selected)
@@ -407,6 +379,12 @@ class MainWindow(QMainWindow):
         self.var_table.itemSelectionChanged.connect(self.var_entered)
         self.var_table.cellChanged.connect(self.var_changed)
         self.gen_section_list.itemSelectionChanged.connect(self.gen_read_current)
+        # Run log
+        self.run_scriptout.setMaximumBlockCount(RUN_LOG_LINES)
+        self.run_log_timer = QTimer(self)
+        self.run_log_timer.setSingleShot(True)
+        self.run_log_timer.setInterval(1000 // RUN_LOG_FPS)
+        self.run_log_timer.timeout.connect(self.run_log_flush)
         # Spinner
         movie = QMovie("ui/skull.gif")
         movie.setScaledSize(QSize(50, 50))
@@ -433,17 +411,20 @@ class MainWindow(QMainWindow):
         try:
             self.atk = attack.Attack.load(new_path)
             self.atk_path = new_path
+            self.set_journal(journal.Journal(new_path))
+            recovered = self.journal.replay(self.atk)
             self.script_clear()
             self.doc_clear()
-            for script_section in self.atk.script.sections:
-                self.script_section_add_existing(script_section)
-            for doc_section in self.atk.document.sections:
-                self.doc_section_add_existing(doc_section)
+            self.script_section_add_existing(self.atk.script.sections)
+            self.doc_section_add_existing(self.atk.document.sections)
             self.var_load()
             self.gen_load()
             self.setWindowTitle(f"APT - {self.atk.meta.name}")
             self.atk_saved = True
-        except KeyError:
+            if recovered:
+                self.mark_unsaved_changes()
+                QErrorMessage(self).showMessage(f"Recovered {recovered} unsaved change(s) from the journal.")
+        except (KeyError, ValueError):
             err = QErrorMessage(self)
             err.finished.connect(self.open_attack)
             err.showMessage("Attack was invalid.")
@@ -456,6 +437,8 @@ class MainWindow(QMainWindow):
             self.save_attack_as()
         else:
             self.atk.save(self.atk_path)
+            if self.journal is not None:
+                self.journal.saved()
             self.setWindowTitle(
                 f"APT - {self.windowTitle().removeprefix('APT - ').removeprefix('*')}")  # Remove unsaved *
             self.atk_saved = True
@@ -468,6 +451,9 @@ class MainWindow(QMainWindow):
         self.atk_path = sav
         try:
             self.atk.save(sav)
+            if self.journal is not None:
+                self.journal.clear()
+            self.set_journal(journal.Journal(sav))
             self.setWindowTitle(
                 f"APT - {self.windowTitle().removeprefix('APT - ').removeprefix('*')}")  # Remove unsaved *
             self.atk_saved = True
@@ -479,8 +465,27 @@ class MainWindow(QMainWindow):
     def dlg_no_attack_open(self):
         QErrorMessage(self).showMessage("Please Open or Make an attack first.")
 
+    def set_journal(self, new: Optional[journal.Journal]):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = new
+
+    def journal_head(self):
+        if self.journal is not None and not self.atk_saved:
+            self.journal.record_head(self.atk)
+
+    def autosave(self):
+        if self.journal is not None and self.journal.records and not self.atk_saved:
+            self.journal_timer.stop()
+            self.journal.compact(self.atk, self.atk_path)
+            self.setWindowTitle(
+                f"APT - {self.windowTitle().removeprefix('APT - ').removeprefix('*')}")  # Remove unsaved *
+            self.atk_saved = True
+
     def mark_unsaved_changes(self, filename=""):
         self.atk_saved = False
+        if not self.loading:
+            self.journal_timer.start()
         if filename == "":
             self.setWindowTitle(f"APT - *{self.windowTitle().removeprefix('APT - ').removeprefix('*')}")
         else:
@@ -502,8 +507,8 @@ class MainWindow(QMainWindow):
         self.script_section_list.addItem(f"{new_id}: Unnamed Section")
         self.mark_unsaved_changes()
 
-    def script_section_add_existing(self, section: attack.SectionScript):
-        self.script_section_list.addItem(f"{section.section_id}: {section.name}")
+    def script_section_add_existing(self, sections: list[attack.SectionScript]):
+        self.script_section_list.addItems([f"{section.section_id}: {section.name}" for section in sections])
 
     def script_section_remove_selected(self):
         try:
@@ -642,7 +647,8 @@ class MainWindow(QMainWindow):
             pass
 
     def run_start_attack(self):
-        self.run_scriptout.document().setPlainText("")
+        self.run_log_pending.clear()
+        self.run_scriptout.clear()
         self.run_button.setDisabled(True)
         self.run_pause_button.setEnabled(True)
         self.run_stop_button.setEnabled(True)
@@ -653,9 +659,11 @@ class MainWindow(QMainWindow):
                               self.atk.script.sections,
                               self.prefix,
                               self.postfix,
-                              self.atk.variables)
+                              self.atk.variables,
+                              log=self.journal)
         self.workers.append(worker)
         worker.signals.append_scriptout.connect(self.run_append_to_scriptout)
+        worker.signals.append_chunk.connect(self.run_append_chunk)
         worker.signals.change_statusline.connect(self.run_set_statusline)
         worker.signals.append_scriptout_from_section.connect(self.run_append_scriptout_from_section)
         worker.signals.append_output.connect(self.run_append_output)
@@ -676,33 +684,86 @@ class MainWindow(QMainWindow):
 
     def run_stop(self):
         for worker in self.workers:
-            worker.kill()
+            worker.kill()  # Its finished signal calls run_attack_finished.
         self.workers = []
         self.pool.waitForDone(1)
-        self.run_attack_finished()
 
     def run_attack_finished(self):
+        self.workers = []
         self.run_button.setEnabled(True)
         self.run_pause_button.setDisabled(True)
         self.run_stop_button.setDisabled(True)
         self.run_set_statusline("Done")
+        if self.atk is not None:
+            self.run_append_to_scriptout(f"{'=' * 10}\nRun summary\n{'=' * 10}\n"
+                                         f"{runstats.format_summary(self.atk, RUN_SUMMARY_ROWS)}\n")
         self.mark_unsaved_changes()
 
+    def export_run_stats(self):
+        try:
+            path = QFileDialog.getSaveFileName(self,
+                                               "Export Run Stats",
+                                               f"{os.path.expanduser('~')}\\{self.atk.meta.name}_stats.json",
+                                               "JSON Files(*.json)")[0]
+        except AttributeError:  # No attack open.
+            self.dlg_no_attack_open()
+            return
+        if path:
+            runstats.export(self.atk, path)
+
+    def set_report_profile(self, profile: profiler.Profiler):
+        self.report_profile = profile
+
+    def export_report_profile(self):
+        if self.report_profile is None:
+            QErrorMessage(self).showMessage("Generate a report or preview first.")
+            return
+        path = QFileDialog.getSaveFileName(self,
+                                           "Export Report Profile",
+                                           f"{os.path.expanduser('~')}\\report_profile.trace.json",
+                                           "Trace Events(*.trace.json);;JSON Files(*.json)")[0]
+        if path:
+            self.report_profile.export(path)
+
     def run_append_to_scriptout(self, text: str):
-        doc = self.run_scriptout.document()
-        doc.setPlainText(f"{doc.toPlainText()}\n{text}")
+        self.run_append_chunk(f"\n{text}")
+
+    def run_append_chunk(self, text: str):
+        self.run_log_pending.append(text)
+        if not self.run_log_timer.isActive():
+            self.run_log_timer.start()
+
+    def run_log_flush(self):
+        """Draw the run output that arrived since the last frame, keeping the view at the end if it was there."""
+        if not self.run_log_pending:
+            return
+        text = "".join(self.run_log_pending)
+        self.run_log_pending.clear()
+        scrollbar = self.run_scriptout.verticalScrollBar()
+        at_end = scrollbar.value() == scrollbar.maximum()
+        cursor = QTextCursor(self.run_scriptout.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(text)
+        if at_end:
+            scrollbar.setValue(scrollbar.maximum())
 
     def run_append_scriptout_from_section(self):
-        self.run_append_to_scriptout(self.atk.output.sections[-1].content)
+        # Only what fits in the scrollback, big output is read from its end rather than read whole to show it.
+        streams = self.atk.output.sections[-1].streams()
+        stdout = store.tail(streams["stdout"], RUN_LOG_LINES)
+        stderr = store.tail(streams["stderr"], RUN_LOG_LINES)
+        self.run_append_to_scriptout(f"stdout:\n{stdout}\nstderr:\n{stderr}")
 
     def run_set_statusline(self, text: str):
         self.run_statusline.setText(text)
 
-    def run_append_output(self, new: attack.SectionOutput):
-        for out_section in self.atk.output.sections:
-            if out_section.section_id == new.section_id:
-                self.atk.output.sections.remove(out_section)
-        self.atk.output.sections.append(new)
+    def run_append_output(self, new: attack.SectionOutput, record: Optional[int]):
+        # Moved to the end rather than replaced, run_append_scriptout_from_section shows the last one.
+        self.atk.output.remove_section(new.section_id)
+        self.atk.output.add_section(new)
+        if self.journal is not None and record is not None:
+            self.journal.applied(record)
+        self.mark_unsaved_changes()
 
     def doc_section_add_new(self):
         if self.atk is None:
@@ -722,8 +783,8 @@ class MainWindow(QMainWindow):
         self.gen_load()
         self.mark_unsaved_changes()
 
-    def doc_section_add_existing(self, section: attack.SectionDocument):
-        self.doc_section_list.addItem(f"{section.section_id}: {section.name}")
+    def doc_section_add_existing(self, sections: list[attack.SectionDocument]):
+        self.doc_section_list.addItems([f"{section.section_id}: {section.name}" for section in sections])
 
     def doc_section_remove_selected(self):
         try:
@@ -869,8 +930,8 @@ class MainWindow(QMainWindow):
 
     def gen_load(self):
         self.gen_clear()
-        for section in self.atk.document.sections:
-            self.gen_section_list.addItem(f"{section.section_id}: {section.name}")
+        self.gen_section_list.addItems([f"{section.section_id}: {section.name}"
+                                        for section in self.atk.document.sections])
 
     def gen_clear(self):
         self.gen_section_list.clear()
@@ -889,24 +950,41 @@ class MainWindow(QMainWindow):
             current = self.atk.document.sections[current_index]
             current.content = self.gen_quick_edit.document().toPlainText()
             self.mark_unsaved_changes()
+            if self.gen_live_preview.isChecked():
+                self.preview_timer.start()  # Restarted by every edit.
         except IndexError:
             if self.atk is None:
                 QErrorMessage(self).showMessage("Please Open or Make an attack first.")
             else:
                 QErrorMessage(self).showMessage("Please add at least one document section and select it here.")
 
+    def gen_live_refresh(self):
+        if self.atk is not None and self.gen_section_list.selectedItems():
+            self.gen_refresh()
+
     def gen_refresh(self):
+        if self.preview_worker is not None:
+            # Only the newest preview is shown, so the next one waits for this one to stop. Any number asked
+            # for in the meantime make one preview, of the text as it is when it starts.
+            self.preview_pending = True
+            self.preview_worker.cancel()
+            return
         try:
             self.gen_button_generate.setDisabled(True)
             self.gen_button_refresh.setDisabled(True)
             current_index = [self.gen_section_list.row(i) for i in self.gen_section_list.selectedItems()][0]
             current = self.atk.document.sections[current_index]
             filename = f"{self.atk.meta.name}_section_{current.section_id}"
-            worker = DocumentWorker(current.section_id, filename, self.atk_path, self.atk, self.app_dir)
-            self.workers.append(worker)
+            self.preview_generation += 1
+            worker = DocumentWorker(current.section_id, filename, self.atk_path, self.atk, self.app_dir,
+                                    cache=self.report_cache, pages=self.page_cache, formats=self.latex_formats,
+                                    generation=self.preview_generation, first=self.gen_cur_pic or 0)
+            self.preview_worker = worker
             worker.signals.change_statusline.connect(self.gen_set_statusline)
+            worker.signals.profiled.connect(self.set_report_profile)
             worker.signals.finished.connect(self.gen_finished)
             worker.signals.new_preview.connect(self.gen_new_pix)
+            worker.signals.preview_page.connect(self.gen_new_page)
             self.pool.start(worker)
         except IndexError:
             if self.atk is None:
@@ -920,9 +998,11 @@ class MainWindow(QMainWindow):
         try:
             self.gen_button_generate.setDisabled(True)
             self.gen_button_refresh.setDisabled(True)
-            worker = DocumentWorker(-1, self.atk.meta.name, self.atk_path, self.atk, self.app_dir)
-            self.workers.append(worker)
+            worker = DocumentWorker(-1, self.atk.meta.name, self.atk_path, self.atk, self.app_dir,
+                                    cache=self.report_cache, formats=self.latex_formats)
+            self.report_worker = worker
             worker.signals.change_statusline.connect(self.gen_set_statusline)
+            worker.signals.profiled.connect(self.set_report_profile)
             worker.signals.finished.connect(self.gen_finished)
             self.pool.start(worker)
         except AttributeError:
@@ -931,6 +1011,15 @@ class MainWindow(QMainWindow):
             self.gen_button_refresh.setDisabled(False)
 
     def gen_finished(self, section: int):
+        if self.report_worker is not None and self.sender() is self.report_worker.signals:
+            self.report_worker = None
+        if self.preview_worker is not None and self.sender() is self.preview_worker.signals:
+            self.preview_worker = None
+            if self.preview_pending:
+                self.preview_pending = False
+                if self.atk is not None and self.gen_section_list.selectedItems():
+                    self.gen_refresh()
+                    return
         if section >= 0:
             print("Section preview not finished.")
         else:
@@ -941,18 +1030,32 @@ class MainWindow(QMainWindow):
     def gen_set_statusline(self, text: str):
         self.gen_statusline.setText(text)
 
-    def gen_new_pix(self, pix: list[QPixmap]):
-        self.gen_cur_pic = 0
-        self.gen_pix = pix
-        self.gen_pageview.setPixmap(self.gen_pix[self.gen_cur_pic])
+    def gen_new_pix(self, generation: int, count: int):
+        if generation != self.preview_generation:
+            return  # From a preview that was replaced.
+        self.gen_cur_pic = max(0, min(self.gen_cur_pic or 0, count - 1))  # Stay on the same page if it's still there.
+        self.gen_pix = [None] * count  # Filled in by gen_new_page.
+
+    def gen_new_page(self, generation: int, number: int, image: QImage):
+        if generation != self.preview_generation or number >= len(self.gen_pix):
+            return
+        self.gen_pix[number] = QPixmap.fromImage(image)
+        if number == self.gen_cur_pic:
+            self.gen_show_page()
+
+    def gen_show_page(self):
+        if self.gen_pix[self.gen_cur_pic] is None:
+            self.gen_pageview.setText("Loading page...")  # Shown once preview_page brings it.
+        else:
+            self.gen_pageview.setPixmap(self.gen_pix[self.gen_cur_pic])
 
     def gen_preview_next(self):
         self.gen_cur_pic = (self.gen_cur_pic + 1) % len(self.gen_pix)
-        self.gen_pageview.setPixmap(self.gen_pix[self.gen_cur_pic])
+        self.gen_show_page()
 
     def gen_preview_prev(self):
         self.gen_cur_pic = (self.gen_cur_pic - 1) % len(self.gen_pix)
-        self.gen_pageview.setPixmap(self.gen_pix[self.gen_cur_pic])
+        self.gen_show_page()
 
     def app_quit(self):
         if not self.atk_saved:
@@ -969,5 +1072,6 @@ if __name__ == "__main__":
         window.prefix = p.read()
     with open(f"{window.app_dir}/postfix.bat", 'r') as p:
         window.postfix = p.read()
+    app.aboutToQuit.connect(window.latex_formats.close)
     window.show()
     app.exec()
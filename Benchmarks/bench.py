@@ -0,0 +1,212 @@
+"""
+Benchmarks for the attack model, the pattern engine and the report pipeline.
+Each benchmark is timed --repeat times on a synthetic attack (see synthetic.py), the best and median are kept.
+LaTeX is stubbed out, reports are built up to the .tex the compiler would get, so the numbers are about this
+code and not the TeX install.
+
+Results are compared against a stored baseline, baseline.json next to this file by default,
+anything more than --threshold times slower is reported as a regression:
+  python Benchmarks/bench.py                    Run and compare.
+  python Benchmarks/bench.py --save-baseline    Run and store the results as the new baseline.
+  python Benchmarks/bench.py --sections 200 --output-mb 64 --only load
+Baselines are only comparable when made on the same machine with the same sizes.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import synthetic  # Puts App on the path.
+
+import attack  # noqa: E402
+import report  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MIN_SAMPLE = 0.2  # Seconds each timed sample takes at least.
+
+
+@contextlib.contextmanager
+def stub_latex():
+    """Make reports write the .tex and an empty pdf instead of running the compiler."""
+    def compile_pdf(tex, path, *args, **kwargs):
+        with open(path + ".tex", "w", encoding="UTF-8") as f:
+            f.write(tex)
+        with open(path + ".pdf", "wb"):
+            pass
+
+    original = report.latex.compile_pdf
+    report.latex.compile_pdf = compile_pdf
+    try:
+        yield
+    finally:
+        report.latex.compile_pdf = original
+
+
+def read_all(atk: attack.Attack):
+    """Use every output, lazily loaded output is only read then."""
+    for output in [atk.output] + list(atk.targets.values()):
+        if output is not None:
+            for section in output.sections:
+                len(section.stdout)
+
+
+def forget_matches(atks: list[attack.Attack]):
+    """Drop the pattern matches kept on the outputs, so cold runs search again."""
+    for atk in atks:
+        for section in atk.output.sections:
+            section.matches = {}
+
+
+def benchmarks(atk: attack.Attack, tmp: str) -> dict[str, Callable[[], None]]:
+    json_path = os.path.join(tmp, "bench.atk")
+    packed_path = os.path.join(tmp, "bench_packed.atk")
+    atk.save(json_path, packed=False)
+    atk.save(packed_path, packed=True)
+    as_dict = atk.to_dict()
+    report_path = os.path.join(tmp, "report")
+    atks = [atk] if not atk.targets else [atk.for_target(target) for target in atk.targets]
+
+    def matching_patterns():
+        forget_matches(atks)
+        for target_atk in atks:
+            rep = report.Report(target_atk)
+            for section in target_atk.document.sections:
+                rep.get_matching_patterns(section.section_id)
+
+    def render_cold():
+        forget_matches(atks)
+        for target_atk in atks:
+            rep = report.Report(target_atk, report.ReportCache())
+            for section in target_atk.document.sections:
+                rep.render_section(section.section_id)
+
+    warm = report.ReportCache()
+
+    def render_warm():
+        for target_atk in atks:
+            rep = report.Report(target_atk, warm)
+            for section in target_atk.document.sections:
+                rep.render_section(section.section_id)
+
+    def report_stubbed():
+        forget_matches(atks)
+        with stub_latex():
+            rep = report.Report(atk, report.ReportCache())
+            if atk.targets:
+                rep.create_targets_report(report_path)
+            else:
+                rep.create_report(report_path)
+
+    def section_preview_stubbed():
+        forget_matches(atks)
+        with stub_latex():
+            section_id = atks[0].document.sections[0].section_id
+            report.Report(atks[0], report.ReportCache()).create_section_preview(report_path + "_section", section_id)
+
+    return {
+        "save_json": lambda: atk.save(os.path.join(tmp, "save.atk"), packed=False),
+        "save_packed": lambda: atk.save(os.path.join(tmp, "save_packed.atk"), packed=True),
+        "load_json": lambda: attack.Attack.load(json_path),
+        "load_json_read_output": lambda: read_all(attack.Attack.load(json_path)),
+        "load_packed": lambda: attack.Attack.load(packed_path),
+        "load_packed_read_output": lambda: read_all(attack.Attack.load(packed_path)),
+        "to_dict": atk.to_dict,
+        "from_dict": lambda: attack.Attack.from_dict(as_dict),
+        "matching_patterns": matching_patterns,
+        "render_sections_cold": render_cold,
+        "render_sections_warm": render_warm,
+        "section_preview_stubbed_latex": section_preview_stubbed,
+        "report_stubbed_latex": report_stubbed,
+    }
+
+
+def measure(function: Callable[[], None], repeat: int) -> dict:
+    """Seconds per call. Fast functions are called several times per sample, single calls are too noisy."""
+    start = time.perf_counter()
+    function()
+    number = max(1, int(MIN_SAMPLE / max(time.perf_counter() - start, 1e-9)))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {"best": min(times), "median": statistics.median(times), "calls": number}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print results next to the baseline. Returns the names of the benchmarks that got slower."""
+    regressions = []
+    print(f"{'benchmark':32}{'best':>10}{'median':>10}{'baseline':>10}{'ratio':>8}")
+    for name, result in results.items():
+        line = f"{name:32}{result['best']:>9.4f}s{result['median']:>9.4f}s"
+        base = baseline.get(name)
+        if base is not None:
+            ratio = result["best"] / base["best"] if base["best"] else float("inf")
+            line += f"{base['best']:>9.4f}s{ratio:>7.2f}x"
+            if ratio > threshold:
+                line += "  SLOWER"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the attack model, patterns and reports.")
+    parser.add_argument("--sections", type=int, default=40)
+    parser.add_argument("--patterns", type=int, default=15, help="patterns per document section")
+    parser.add_argument("--output-mb", type=float, default=8, help="MB of output over all sections")
+    parser.add_argument("--targets", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", metavar="TEXT", help="only run benchmarks with TEXT in their name")
+    parser.add_argument("--baseline", metavar="FILE", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="how many times slower than the baseline counts as a regression (default: 1.5)")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args(argv)
+
+    params = {"sections": args.sections, "patterns": args.patterns, "output_mb": args.output_mb,
+              "targets": args.targets, "seed": args.seed}
+    atk = synthetic.make_attack(**params)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, function in benchmarks(atk, tmp).items():
+            if args.only and args.only not in name:
+                continue
+            function()  # Warm up, imports and caches like combined_regex shouldn't count.
+            results[name] = measure(function, args.repeat)
+    run = {"params": params, "python": platform.python_version(), "machine": platform.machine(),
+           "results": results}
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            stored = json.load(f)
+        if stored["params"] == params:
+            baseline = stored["results"]
+        else:
+            print(f"Baseline was made with {stored['params']}, not comparing.", file=sys.stderr)
+    regressions = compare(results, baseline, args.threshold)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Wrote {args.baseline}", file=sys.stderr)
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
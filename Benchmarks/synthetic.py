@@ -0,0 +1,105 @@
+"""
+Synthetic attacks for the benchmarks, built from the sample nmap logs in App/nmap/scan_log.
+Every section's output is those logs over and over with other addresses, so patterns and nmap queries
+match like they would on a real scan. The same arguments always make the same attack.
+
+python Benchmarks/synthetic.py big.atk --sections 100 --patterns 30 --output-mb 64
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "App")
+sys.path.insert(0, APP_DIR)
+
+import attack  # noqa: E402
+
+SEED_IP = "192.168.114.131"  # Address in the sample logs, swapped for a made up one in each copy.
+
+# Patterns like the ones attacks use, {port} is filled in to make each one different.
+REGEX_PATTERNS = [r"{port}/tcp\s+open", r"(\d+)/tcp\s+open\s+ssh", r"vsftpd 2\.3\.4", r"Samba smbd \d\.X",
+                  r"OpenSSH [\d.]+p\d", r"Host is up \(([\d.]+)s latency\)", r"{port}/udp\s+open\|filtered"]
+QUERY_PATTERNS = ["nmap: port={port} state=open", "nmap: service=netbios-ssn", "nmap: version~samba",
+                  "nmap: script=smb-os-discovery output~Windows"]
+
+
+def seed_logs() -> list[str]:
+    logs = []
+    for path in sorted(glob.glob(os.path.join(APP_DIR, "nmap", "scan_log", "*.txt"))):
+        with open(path, "r", encoding="UTF-8") as f:
+            logs.append(f.read())
+    return logs
+
+
+def fake_output(rng: random.Random, logs: list[str], size: int) -> str:
+    """Sample logs until the text is about size characters."""
+    parts = []
+    length = 0
+    while length < size:
+        log = rng.choice(logs).replace(SEED_IP, f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}")
+        parts.append(log)
+        length += len(log)
+    return "\n".join(parts)
+
+
+def make_patterns(rng: random.Random, count: int) -> list[attack.Pattern]:
+    found = []
+    for i in range(count):
+        source = QUERY_PATTERNS if rng.random() < 0.2 else REGEX_PATTERNS
+        pattern_str = rng.choice(source).format(port=rng.choice([21, 22, 80, 139, 445, 3306, rng.randrange(65536)]))
+        behavior = attack.PatternBehavior.REPLACE if rng.random() < 0.2 else attack.PatternBehavior.ADD
+        found.append(attack.Pattern(pattern_str, f"\\textbf{{Finding {i}}} was found.\n", behavior))
+    return found
+
+
+def make_attack(sections: int = 20, patterns: int = 10, output_mb: float = 4, targets: int = 0,
+                seed: int = 0) -> attack.Attack:
+    """
+    An attack with sections script sections, a document section with patterns patterns for each,
+    and about output_mb MB of output spread over the sections. With targets, each target gets its own output,
+    as if the attack was run against that many hosts.
+    """
+    rng = random.Random(seed)
+    logs = seed_logs()
+    meta = attack.Meta(f"bench_{sections}s_{patterns}p_{output_mb:g}mb", "benchmarks", "1.0.0", "0.0.0")
+    script = attack.Script([attack.SectionScript(i, f"Scan {i}", attack.ScriptSectionType.EMBEDDED,
+                                                 f"nmap -sV -sC %ip% -p {rng.randrange(1, 65536)}")
+                            for i in range(sections)], ["nmap"])
+    document = attack.Document([attack.SectionDocument(i, f"Findings {i}", attack.DocumentSectionType.PATTERN,
+                                                       f"Nothing of note was found by scan {i}.\n",
+                                                       make_patterns(rng, patterns))
+                                for i in range(sections)])
+    section_size = int(output_mb * 1024 * 1024 / max(sections, 1) / max(targets, 1))
+
+    def make_output() -> attack.Output:
+        return attack.Output([attack.SectionOutput(i, fake_output(rng, logs, section_size), "")
+                              for i in range(sections)])
+
+    atk = attack.Attack(meta, script, document, {"ip": "10.0.0.1"})
+    if targets:
+        atk.targets = {f"10.0.1.{i}": make_output() for i in range(targets)}
+    else:
+        atk.output = make_output()
+    return atk
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Write a synthetic attack for benchmarking.")
+    parser.add_argument("path", help="where to write the .atk")
+    parser.add_argument("--sections", type=int, default=20)
+    parser.add_argument("--patterns", type=int, default=10, help="patterns per document section")
+    parser.add_argument("--output-mb", type=float, default=4, help="MB of output over all sections")
+    parser.add_argument("--targets", type=int, default=0, help="split the output over this many targets")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--packed", action="store_true", help="save in the packed format")
+    args = parser.parse_args(argv)
+    atk = make_attack(args.sections, args.patterns, args.output_mb, args.targets, args.seed)
+    atk.save(args.path, args.packed or None)  # Otherwise picked by size, as usual.
+    print(f"Wrote {args.path}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())